@@ -0,0 +1,85 @@
+"""
+    Time spent filtering whole runs with the Gabor filter bank of cell_boundary: the per-frame path it used to take,
+    rebuilding the kernels and running cv2.filter2D on each frame, against GaborFilterBank.apply_stack with one and
+    several worker threads. Larger kernels are also timed on the spatial and the FFT paths of the bank.
+
+    Run from the repository root:
+        python -m benchmarks.gabor_bank --frames 50 --size 1024 --workers 1 4
+"""
+import argparse
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from cell import GaborFilterBank
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def make_run(n_frames, size, seed=0):
+    # float images as gabor_response feeds them to the bank
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 65535, size=(n_frames, size, size))
+
+
+def per_frame(stack):
+    # what cell_boundary used to do on every frame
+    out = list()
+    for img in stack:
+        filters = []
+        ksize = 9
+        for theta in np.arange(0, np.pi, np.pi / 8):
+            kern = cv2.getGaborKernel((ksize, ksize), 4.0, theta, 6.0, 0.5, 0, ktype=cv2.CV_32F)
+            kern /= kern.sum()
+            filters.append(kern)
+        accum = np.zeros_like(img)
+        for kern in filters:
+            fimg = cv2.filter2D(img, cv2.CV_16UC1, kern)
+            np.maximum(accum, fimg, accum)
+        out.append(accum)
+    return np.stack(out)
+
+
+def best_of(fn, repeat):
+    times = list()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Timing of the Gabor filter bank over whole runs.')
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--ksizes', type=int, nargs='+', default=[9, 15, 31, 61])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    stack = make_run(args.frames, args.size)
+    bank = GaborFilterBank()
+    assert np.array_equal(per_frame(stack[:2]), bank.apply_stack(stack[:2], workers=1))
+
+    print('%-24s %12s %14s' % ('path', 'run (s)', 'frame (ms)'))
+    t = best_of(lambda: per_frame(stack), args.repeat)
+    print('%-24s %12.3f %14.1f' % ('per frame', t, 1e3 * t / args.frames))
+    for workers in args.workers:
+        t = best_of(lambda: bank.apply_stack(stack, workers=workers), args.repeat)
+        print('%-24s %12.3f %14.1f' % ('bank, %d workers' % workers, t, 1e3 * t / args.frames))
+
+    # kernel size against convolution path, on a few frames
+    frames = stack[:min(5, args.frames)]
+    print()
+    print('%8s %14s %14s %12s' % ('ksize', 'spatial (ms)', 'fft (ms)', 'max diff'))
+    for ksize in args.ksizes:
+        scale = ksize / 9.0
+        spatial = GaborFilterBank(ksize=ksize, sigma=4.0 * scale, lambd=6.0 * scale, fft_ksize=np.inf)
+        fft = GaborFilterBank(ksize=ksize, sigma=4.0 * scale, lambd=6.0 * scale, fft_ksize=0)
+        t_spatial = best_of(lambda: spatial.apply_stack(frames, workers=1), args.repeat)
+        t_fft = best_of(lambda: fft.apply_stack(frames, workers=1), args.repeat)
+        diff = np.abs(spatial.apply(frames[0]) - fft.apply(frames[0])).max()
+        print('%8d %14.1f %14.1f %12.1f' % (ksize, 1e3 * t_spatial / len(frames), 1e3 * t_fft / len(frames), diff))
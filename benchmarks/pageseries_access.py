@@ -0,0 +1,59 @@
+"""
+    Time to read the last frame of TZCYX z-stack movies of increasing length with retrieve_from_pageseries, against
+    decoding the whole series as it used to. Movies are written both as contiguous ImageJ hyperstacks and with one
+    compressed page per plane.
+
+    Run from the repository root:
+        python -m benchmarks.pageseries_access --frames 5 20 80
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from tools.image import retrieve_from_pageseries, tf
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def make_movie(path, n_frames, n_zstacks, n_channels, size, layout, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.randint(0, 4096, size=(n_frames, n_zstacks, n_channels, size, size)).astype(np.uint16)
+    # ImageJ hyperstacks are contiguous unless compressed, which leaves one page per plane
+    tf.imsave(path, data, imagej=True, compress=6 if layout == 'pages' else 0)
+    return data[-1]
+
+
+def best_of(fn, repeat):
+    times = list()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Timing of last-frame access to z-stack movies.')
+    parser.add_argument('--frames', type=int, nargs='+', default=[5, 20, 80])
+    parser.add_argument('--zstacks', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('%-10s %8s %16s %16s' % ('layout', 'frames', 'last frame (ms)', 'whole (ms)'))
+    for layout in ['imagej', 'pages']:
+        for n in args.frames:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'movie.tif')
+                last = make_movie(path, n, args.zstacks, args.channels, args.size, layout)
+                with tf.TiffFile(path) as tif:
+                    series = tif.series[0]
+                    assert np.array_equal(retrieve_from_pageseries(series, n - 1), last)
+                    t_frame = best_of(lambda: retrieve_from_pageseries(series, n - 1), args.repeat)
+                    t_whole = best_of(lambda: series.asarray()[n - 1], args.repeat)
+            print('%-10s %8d %16.1f %16.1f' % (layout, n, 1e3 * t_frame, 1e3 * t_whole))
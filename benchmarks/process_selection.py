@@ -0,0 +1,89 @@
+"""
+    Time spent by LabHDF5NeXusFile.process_selection_for_run on synthetic runs with an increasing number of tracked
+    centrosomes, two per nucleus, along with the relabelling step alone compared against the per-centrosome .loc
+    loop it replaced.
+
+    Run from the repository root:
+        python -m benchmarks.process_selection --centrosomes 10 100 1000
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from imagej.hdf5_nexus import LabHDF5NeXusFile, relabel_selection
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def make_run(path, n_centrosomes, n_frames=30, seed=0):
+    rng = np.random.RandomState(seed)
+    centrosomes, nuclei = list(), list()
+    for n in range(1, n_centrosomes // 2 + 1):
+        nx, ny = rng.uniform(20, 200, 2)
+        bound = '[[%s]]' % ', '.join('[%0.2f, %0.2f]' % (nx + 5 * np.cos(a), ny + 5 * np.sin(a))
+                                     for a in np.linspace(0, 2 * np.pi, 8))
+        for fr in range(n_frames):
+            nuclei.append({'Frame': fr, 'Nuclei': n, 'NuclX': nx, 'NuclY': ny, 'NuclBound': bound})
+        for c in [2 * n - 1, 2 * n]:
+            for fr in range(n_frames):
+                centrosomes.append({'Frame': fr, 'Time': fr * 60.0, 'Nuclei': n, 'Centrosome': c,
+                                    'CentX': nx + rng.randn() * 3, 'CentY': ny + rng.randn() * 3,
+                                    'ValidCentroid': 1})
+    pd.DataFrame(centrosomes).to_csv(os.path.join(path, 'run-001-table.csv'), index=False)
+    pd.DataFrame(nuclei).to_csv(os.path.join(path, 'run-001-nuclei.csv'), index=False)
+    return os.path.join(path, 'run-001-table.csv')
+
+
+def relabel_loop(measured, selection):
+    # the relabelling process_selection_for_run used to do, one full column scan per selected centrosome
+    measured = measured.copy()
+    centrosomes_all = list()
+    for nuclei_id in selection.nuclei:
+        centrosomes_of_nuclei_a = selection.centrosomes(nuclei_id, label=0)
+        centrosomes_of_nuclei_b = selection.centrosomes(nuclei_id, label=1)
+        for centr_id in centrosomes_of_nuclei_a + centrosomes_of_nuclei_b:
+            measured.loc[measured['Centrosome'] == centr_id, 'Nuclei'] = nuclei_id
+        for centr_id in centrosomes_of_nuclei_a:
+            measured.loc[measured['Centrosome'] == centr_id, 'CentrLabel'] = 'A'
+        for centr_id in centrosomes_of_nuclei_b:
+            measured.loc[measured['Centrosome'] == centr_id, 'CentrLabel'] = 'B'
+        centrosomes_all.extend(centrosomes_of_nuclei_a + centrosomes_of_nuclei_b)
+    return measured[measured['Centrosome'].isin(centrosomes_all)]
+
+
+def best_of(fn, repeat):
+    times = list()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Timing of process_selection_for_run.')
+    parser.add_argument('--centrosomes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('%12s %14s %14s %14s' % ('centrosomes', 'process (s)', 'relabel (s)', 'loc loop (s)'))
+    for n in args.centrosomes:
+        with tempfile.TemporaryDirectory() as tmp:
+            csv = make_run(tmp, n, n_frames=args.frames)
+            hdf5 = LabHDF5NeXusFile(filename=os.path.join(tmp, 'bench.nexus.h5'), fileflag='w')
+            hdf5.add_experiment('bench', 'run_001')
+            hdf5.add_measurements(csv, 'bench', 'run_001')
+
+            selection = hdf5.selection('bench', 'run_001')
+            measured = pd.read_hdf(hdf5.filename, key='bench/run_001/measurements/pandas_dataframe')
+
+            t_process = best_of(lambda: hdf5.process_selection_for_run('bench', 'run_001'), args.repeat)
+            t_relabel = best_of(lambda: relabel_selection(measured, selection), args.repeat)
+            t_loop = best_of(lambda: relabel_loop(measured, selection), args.repeat)
+        print('%12d %14.3f %14.4f %14.4f' % (n, t_process, t_relabel, t_loop))
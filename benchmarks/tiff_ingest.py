@@ -0,0 +1,82 @@
+"""
+    Peak memory of ingesting a large ImageJ hyperstack into the HDF5 NeXus file, comparing the streaming path of
+    LabHDF5NeXusFile.add_tiff_sequence against decoding the whole hyperstack in memory before writing.
+    Each mode runs in its own process so its peak resident set size can be measured in isolation.
+
+    Run from the repository root:
+        python -m benchmarks.tiff_ingest --size-gb 2
+"""
+import argparse
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+import tifffile as tf
+
+from imagej.hdf5_nexus import LabHDF5NeXusFile, read_tiff_metadata
+
+logging.basicConfig(level=logging.INFO)
+
+
+def make_hyperstack(path, size_gb, channels=3, width=1024, height=1024):
+    frames = max(2, int(size_gb * 1024 ** 3 / (channels * width * height * 2)))
+    logging.info('writing synthetic hyperstack of %d frames (%0.2f GB) to %s' %
+                 (frames, frames * channels * width * height * 2 / 1024 ** 3, path))
+    stack = tf.memmap(path, shape=(frames, channels, height, width), dtype=np.uint16, imagej=True,
+                      resolution=(4.5, 4.5), metadata={'unit': 'micron'})
+    rng = np.random.RandomState(0)
+    for t in range(frames):
+        stack[t] = rng.randint(0, 4096, size=(channels, height, width), dtype=np.uint16)
+    stack.flush()
+    del stack
+
+
+def ingest(tiffpath, hdf5path, mode):
+    hdf5 = LabHDF5NeXusFile(filename=hdf5path, fileflag='w')
+    hdf5.add_experiment('bench', 'run_000')
+    if mode == 'streaming':
+        hdf5.add_tiff_sequence(tiffpath, 'bench', 'run_000', layout='stack')
+    else:
+        # what add_tiff_sequence used to do: decode the whole hyperstack, then write it frame by frame
+        with tf.TiffFile(tiffpath, fastij=True) as tif, h5py.File(hdf5path, 'a') as f:
+            meta = read_tiff_metadata(tif)
+            shape = (meta['frames'], meta['channels'], meta['height'], meta['width'])
+            stack = tif.pages[0].asarray().reshape(shape)
+            hdf5._write_raw(f['bench/run_000/raw'], stack, meta, layout='stack')
+
+
+def run_mode(tiffpath, mode):
+    with tempfile.TemporaryDirectory() as tmp:
+        cmd = [sys.executable, '-m', 'benchmarks.tiff_ingest', '--worker', mode, tiffpath, os.path.join(tmp, 'o.h5')]
+        t0 = time.time()
+        subprocess.check_call(cmd)
+        elapsed = time.time() - t0
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return elapsed, maxrss / 1024 if sys.platform != 'darwin' else maxrss / 1024 ** 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory of tiff ingestion.')
+    parser.add_argument('--size-gb', type=float, default=2, help='size of the synthetic hyperstack')
+    parser.add_argument('--worker', nargs=3, metavar=('MODE', 'TIFF', 'HDF5'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        mode, tiffpath, hdf5path = args.worker
+        ingest(tiffpath, hdf5path, mode)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tiffpath = os.path.join(tmp, 'run-000.tif')
+        make_hyperstack(tiffpath, args.size_gb)
+        # RUSAGE_CHILDREN reports the maximum over all children so far, so run the lighter mode first
+        for mode in ['streaming', 'in-memory']:
+            elapsed, peak_mb = run_mode(tiffpath, mode)
+            print('%-10s %8.1f s  peak RSS %8.1f MB' % (mode, elapsed, peak_mb))
@@ -1 +1 @@
-from ._im_gabor import cell_boundary
\ No newline at end of file
+from ._im_gabor import GaborFilterBank, cell_boundary, gabor_response, gabor_responses, nuclei_markers, segment_cells
@@ -1,3 +1,7 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import matplotlib.gridspec
 import matplotlib.pyplot as plt
@@ -7,43 +11,124 @@ import skimage.morphology
 import skimage.segmentation
 import tifffile as tf
 from scipy import ndimage as ndi
+from scipy.fftpack import next_fast_len
 from skimage import exposure
 from skimage.filters import gaussian
 from skimage.morphology import erosion, square
 from skimage.segmentation import active_contour
 
 
-def cell_boundary(tubulin, hoechst, fig=None, threshold=80, markers=None):
-    def build_gabor_filters():
-        filters = []
-        ksize = 9
-        for theta in np.arange(0, np.pi, np.pi / 8):
-            kern = cv2.getGaborKernel((ksize, ksize), 4.0, theta, 6.0, 0.5, 0, ktype=cv2.CV_32F)
+class GaborFilterBank(object):
+    """
+        The oriented Gabor kernels of cell_boundary, built once, and their maximum response over an image or over
+        the frames of a (T, Y, X) stack. Small kernels are applied with cv2.filter2D; from fft_ksize up, the image is
+        transformed once and multiplied by the cached spectra of all the kernels, which costs the same whatever the
+        kernel size. Both saturate to 16 bits as cv2.filter2D does, the FFT may round one gray level off.
+    """
+
+    def __init__(self, ksize=9, sigma=4.0, lambd=6.0, gamma=0.5, orientations=8, fft_ksize=15):
+        self.ksize = ksize
+        self.kernels = list()
+        for theta in np.arange(0, np.pi, np.pi / orientations):
+            kern = cv2.getGaborKernel((ksize, ksize), sigma, theta, lambd, gamma, 0, ktype=cv2.CV_32F)
             kern /= kern.sum()
-            filters.append(kern)
-        return filters
+            self.kernels.append(kern)
+        self.use_fft = ksize >= fft_ksize
+        self._spectra = dict()
+        self._lock = threading.Lock()
+
+    def _kernel_spectra(self, shape):
+        # filter2D correlates, so the kernels are flipped to get it from a convolution
+        with self._lock:
+            if shape not in self._spectra:
+                self._spectra[shape] = [np.fft.rfft2(kern[::-1, ::-1], shape) for kern in self.kernels]
+            return self._spectra[shape]
+
+    def apply(self, img):
+        """ Maximum response of the kernels over a 2D image, in an array like img. """
+        if not self.use_fft:
+            accum = np.zeros_like(img)
+            for kern in self.kernels:
+                fimg = cv2.filter2D(img, cv2.CV_16UC1, kern)
+                np.maximum(accum, fimg, accum)
+            return accum
+
+        # the same reflected border as filter2D, and enough room for the convolution not to wrap into the image
+        r = self.ksize // 2
+        h, w = img.shape
+        shape = tuple(next_fast_len(s + 2 * r) for s in (h, w))
+        spectrum = np.fft.rfft2(np.pad(img.astype(np.float32), r, mode='reflect'), shape)
+        accum = None
+        for kspec in self._kernel_spectra(shape):
+            fimg = np.fft.irfft2(spectrum * kspec, shape)[2 * r:2 * r + h, 2 * r:2 * r + w]
+            accum = fimg if accum is None else np.maximum(accum, fimg, accum)
+        return np.clip(np.rint(accum), 0, 65535).astype(img.dtype)
+
+    def apply_stack(self, stack, workers=None):
+        """
+            apply over every frame of a (T, Y, X) stack, spreading the frames over workers threads (all the cores
+            by default); OpenCV and the FFT release the GIL while filtering.
+        """
+        return _map_frames(self.apply, stack, workers)
 
-    def process_gabor(img, filters):
-        accum = np.zeros_like(img)
-        for kern in filters:
-            fimg = cv2.filter2D(img, cv2.CV_16UC1, kern)
-            np.maximum(accum, fimg, accum)
-        return accum
 
-    p2 = np.percentile(tubulin, 2)
-    p98 = np.percentile(tubulin, 98)
-    tubulin = exposure.rescale_intensity(tubulin, in_range=(p2, p98))
-    p2 = np.percentile(hoechst, 2)
-    p98 = np.percentile(hoechst, 98)
-    hoechst = exposure.rescale_intensity(hoechst, in_range=(p2, p98))
+GABOR_BANK = GaborFilterBank()
 
-    img = np.maximum(tubulin, 0.8 * hoechst)
 
+def _map_frames(fn, stack, workers=None):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(stack) < 2:
+        return np.stack([fn(frame) for frame in stack])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.stack(list(executor.map(fn, stack)))
+
+
+def _rescale(channel):
+    p2 = np.percentile(channel, 2)
+    p98 = np.percentile(channel, 98)
+    return exposure.rescale_intensity(channel, in_range=(p2, p98))
+
+
+def gabor_response(tubulin, hoechst, bank=GABOR_BANK):
+    """
+        Stages of cell_boundary that don't depend on the threshold: the rescaled and eroded image of both channels
+        and the maximum response of the Gabor filter bank over it, as an 8-bit image.
+    """
+    img = np.maximum(_rescale(tubulin), 0.8 * _rescale(hoechst))
     img = erosion(img, square(3))
-    filters = build_gabor_filters()
-    gabor = process_gabor(img, filters)
+    gabor = bank.apply(img)
+    return img, cv2.convertScaleAbs(gabor, alpha=(255.0 / 65535.0))
+
+
+def gabor_responses(tubulin, hoechst, workers=None, bank=GABOR_BANK):
+    """
+        8-bit gabor response of every frame of the (T, Y, X) stacks of both channels, as a stack. Frames are
+        processed in parallel over workers threads, all the cores by default.
+    """
+    return _map_frames(lambda t: gabor_response(tubulin[t], hoechst[t], bank=bank)[1], range(len(tubulin)), workers)
+
 
-    gabor = cv2.convertScaleAbs(gabor, alpha=(255.0 / 65535.0))
+def nuclei_markers(hoechst, ksize=31):
+    """ Markers for the watershed, labelled from the hoechst channel. """
+    hoechst_8 = cv2.convertScaleAbs(_rescale(hoechst), alpha=(255.0 / 65535.0))
+    blur_nuc = cv2.GaussianBlur(hoechst_8, (ksize, ksize), 0)
+    ret, bin_nuc = cv2.threshold(blur_nuc, 0, 255, cv2.THRESH_OTSU)
+    return ndi.label(bin_nuc)[0]
+
+
+def cell_boundary(tubulin, hoechst, fig=None, threshold=80, markers=None):
+    img, gabor = gabor_response(tubulin, hoechst)
+    if markers is None:
+        # get markers for watershed from hoescht channel
+        markers = nuclei_markers(hoechst)
+    return segment_cells(gabor, markers, threshold=threshold, img=img, fig=fig)
+
+
+def segment_cells(gabor, markers, threshold=80, img=None, fig=None):
+    """
+        Stages of cell_boundary that depend on the threshold: thresholding of the gabor response, blur and
+        watershed from the nuclei markers. img is only needed to render the steps when fig is given.
+    """
     ret, bin1 = cv2.threshold(gabor, threshold, 255, cv2.THRESH_BINARY)
 
     # gaussian blur on gabor filter result
@@ -52,13 +137,6 @@ def cell_boundary(tubulin, hoechst, fig=None, threshold=80, markers=None):
     ret, bin2 = cv2.threshold(blur, threshold, 255, cv2.THRESH_OTSU)
     # ret, bin2 = cv2.threshold(blur, 70, 255, cv2.THRESH_BINARY)
 
-    if markers is None:
-        # get markers for watershed from hoescht channel
-        hoechst_8 = cv2.convertScaleAbs(hoechst, alpha=(255.0 / 65535.0))
-        blur_nuc = cv2.GaussianBlur(hoechst_8, (ksize, ksize), 0)
-        ret, bin_nuc = cv2.threshold(blur_nuc, 0, 255, cv2.THRESH_OTSU)
-        markers = ndi.label(bin_nuc)[0]
-
     # label cell boundaries starting from each nucleus, using the watershed algorithm
     # distance = ndi.distance_transform_edt(bin2)
     # distance = distance / np.linalg.norm(distance)
@@ -72,39 +150,44 @@ def cell_boundary(tubulin, hoechst, fig=None, threshold=80, markers=None):
 
     labels = skimage.morphology.watershed(-gabor_proc, markers, mask=bin2)
 
-    image = cv2.convertScaleAbs(img, alpha=(255.0 / 65535.0))
-    color = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    render = fig is not None
+    if render:
+        image = cv2.convertScaleAbs(img if img is not None else gabor, alpha=(255.0 / 65535.0))
+        color = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
     boundaries_list = list()
-    # loop over the labels
-    for (i, l) in enumerate([l for l in np.unique(labels) if l > 0]):
-        # find contour of mask
-        cell_boundary = np.zeros(shape=labels.shape, dtype=np.uint8)
-        cell_boundary[labels == l] = 255
-        cnts = cv2.findContours(cell_boundary.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    # loop over the labels, each one on the crop of its bounding box
+    objects = [(l, sl) for l, sl in enumerate(ndi.find_objects(labels), start=1) if sl is not None]
+    for (i, (l, (sy, sx))) in enumerate(objects):
+        # find contour of mask, framed by a pixel of background as on the whole image
+        cell_boundary = np.zeros(shape=(sy.stop - sy.start + 2, sx.stop - sx.start + 2), dtype=np.uint8)
+        cell_boundary[1:-1, 1:-1][labels[sy, sx] == l] = 255
+        offset = (sx.start - 1, sy.start - 1)
+        cnts = cv2.findContours(cell_boundary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
         contour = cnts[0]
 
         do_snake = False
         if do_snake:
-            snake = np.array([[x, y] for x, y in [i[0] for i in contour]], dtype=np.float32)
+            snake = (contour[:, 0, :] + offset).astype(np.float32)
             contour = active_contour(gaussian(gabor, 3), snake, alpha=0.015, beta=0.1, gamma=0.1, w_line=-1.0)
 
             cx, cy = 0, 0
             boundaries_list.append({'id': l, 'boundary': contour, 'centroid': (cx, cy)})
         else:
-            # draw the contour
-            ((x, y), _) = cv2.minEnclosingCircle(contour)
-            cv2.putText(color, '#{}'.format(i + 1), (int(x) - 10, int(y)),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
-            cv2.drawContours(color, contour, -1, (0, 255, 0), 2)
-
             M = cv2.moments(contour)
-            cx = int(M['m10'] / M['m00'])
-            cy = int(M['m01'] / M['m00'])
-            cv2.circle(color, (cx, cy), 5, (0, 255, 0), thickness=-1)
-
-            boundary = np.array([[x, y] for x, y in [i[0] for i in contour]], dtype=np.float32)
+            cx = int(M['m10'] / M['m00'] + offset[0])
+            cy = int(M['m01'] / M['m00'] + offset[1])
+            boundary = (contour[:, 0, :] + offset).astype(np.float32)
             boundaries_list.append({'id': l, 'boundary': boundary, 'centroid': (cx, cy)})
 
+            if render:
+                # draw the contour
+                contour = contour + offset
+                ((x, y), _) = cv2.minEnclosingCircle(contour)
+                cv2.putText(color, '#{}'.format(i + 1), (int(x) - 10, int(y)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+                cv2.drawContours(color, contour, -1, (0, 255, 0), 2)
+                cv2.circle(color, (cx, cy), 5, (0, 255, 0), thickness=-1)
+
     if fig is not None:
         # set-up matplotlib axes
         gs = matplotlib.gridspec.GridSpec(2, 3)
@@ -0,0 +1,104 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+
+
+class FramePrefetcher(threading.Thread):
+    """
+        Loads the frames of a run in a background thread and keeps the last capacity of them in a LRU ring.
+        Every request queues the next frames in the direction the movie is being played, so that the viewer only
+        has to blit what is already in memory.
+        load(hdf5file, condition, run, frame) returns the data of a frame as a dict, with the number of frames of
+        the run under 'frames'. If given, loaded(frame) is called from the prefetch thread every time a frame of
+        the current run is stored, so that a viewer waiting for it can repaint.
+    """
+
+    def __init__(self, load, capacity=48, ahead=12, loaded=None):
+        threading.Thread.__init__(self, name='frame-prefetch', daemon=True)
+        self.load = load
+        self.loaded = loaded
+        self.capacity = capacity
+        self.ahead = ahead
+        self._cache = OrderedDict()
+        self._pending = deque()
+        self._window = set()
+        self._run = None
+        self._frames = 0
+        self._last = None
+        self._direction = 1
+        self._generation = 0
+        self._cv = threading.Condition()
+        self.start()
+
+    def get(self, hdf5file, condition, run, frame):
+        """ Data of a frame if it is already loaded, None otherwise. Either way, the frames ahead are queued. """
+        with self._cv:
+            self._set_run((hdf5file, condition, run))
+            if self._last is not None and self._frames > 0:
+                step = (frame - self._last) % self._frames
+                if step > 0: self._direction = 1 if step <= self._frames // 2 else -1
+            self._last = frame
+            self._queue(frame)
+            data = self._cache.get(frame)
+            if data is not None: self._cache.move_to_end(frame)
+            return data
+
+    def invalidate(self):
+        """ Drops every loaded frame, e.g. after the selection or the boundaries of the run were edited. """
+        with self._cv:
+            self._generation += 1
+            self._cache.clear()
+            self._pending.clear()
+            self._window = set()
+
+    def _set_run(self, run):
+        if run != self._run:
+            self._run = run
+            self._frames = 0
+            self._last = None
+            self.invalidate()
+
+    def _queue(self, frame):
+        self._pending.clear()
+        if self._frames > 0:
+            ahead = [(frame + i * self._direction) % self._frames for i in range(min(self.ahead, self._frames) + 1)]
+        else:
+            ahead = [frame]
+        self._window = set(ahead)
+        self._pending.extend([fr for fr in ahead if fr not in self._cache])
+        self._cv.notify()
+
+    def _store(self, generation, frame, data):
+        # frames loaded for a previous run or before an edit are discarded
+        if generation != self._generation:
+            return False
+        self._frames = data['frames']
+        self._cache[frame] = data
+        self._cache.move_to_end(frame)
+        # the least recently used frames go first, but never those about to be shown
+        while len(self._cache) > self.capacity:
+            old = next((fr for fr in self._cache if fr not in self._window), None)
+            if old is None:
+                self._cache.popitem(last=False)
+            else:
+                del self._cache[old]
+        return True
+
+    def run(self):
+        while True:
+            with self._cv:
+                while not self._pending:
+                    self._cv.wait()
+                frame = self._pending.popleft()
+                if frame in self._cache:
+                    continue
+                run, generation = self._run, self._generation
+            try:
+                data = self.load(*(run + (frame,)))
+            except Exception as e:
+                logging.error('could not prefetch frame %d of %s-%s: %s' % (frame, run[1], run[2], e))
+                continue
+            with self._cv:
+                stored = self._store(generation, frame, data)
+            if stored and self.loaded is not None:
+                self.loaded(frame)
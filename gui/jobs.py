@@ -0,0 +1,92 @@
+import logging
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class _JobSignals(QObject):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class Job(QRunnable):
+    """
+        A processing action of the GUIs, run as fn(job) in a thread of the JobExecutor. fn reports its progress
+        with job.progress(done, total), which is also where a cancelled job stops.
+    """
+
+    def __init__(self, fn, description):
+        QRunnable.__init__(self)
+        self.setAutoDelete(False)
+        self.fn = fn
+        self.description = description
+        self.signals = _JobSignals()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def progress(self, done, total):
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.signals.progress.emit(done, total)
+
+    def run(self):
+        try:
+            if self._cancel.is_set():
+                raise JobCancelled()
+            result = self.fn(self)
+        except JobCancelled:
+            logging.info('%s cancelled.' % self.description)
+            self.signals.cancelled.emit()
+        except Exception as e:
+            logging.exception('%s failed.' % self.description)
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
+
+
+class JobExecutor(QObject):
+    """
+        Runs the processing actions of the GUIs away from the Qt event loop. Jobs run one at a time in the order
+        they were submitted, so they also form the write queue of the HDF5 file. Signals are delivered in the Qt
+        thread, where views can be refreshed once a job is done.
+    """
+    busy = pyqtSignal(bool)
+    progress = pyqtSignal(str, int, int)
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.jobs = list()
+
+    def submit(self, fn, description, on_finished=None):
+        job = Job(fn, description)
+        job.signals.progress.connect(lambda done, total: self.progress.emit(description, done, total))
+        if on_finished is not None:
+            job.signals.finished.connect(on_finished)
+        for signal in [job.signals.finished, job.signals.failed, job.signals.cancelled]:
+            signal.connect(lambda *args, job=job: self._done(job))
+        self.jobs.append(job)
+        if len(self.jobs) == 1: self.busy.emit(True)
+        logging.info('queued %s.' % description)
+        self.pool.start(job)
+        return job
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def wait(self):
+        self.pool.waitForDone()
+
+    def _done(self, job):
+        self.jobs.remove(job)
+        if not self.jobs: self.busy.emit(False)
@@ -0,0 +1,75 @@
+import h5py
+import numpy as np
+import pandas as pd
+
+from imagej import hdf5_nexus as hdf
+from imagej.imagej_pandas import parse_polygon
+
+
+def _by_frame(polygons):
+    # {(nucleus, frame): polygon} regrouped as {frame: {(nucleus, frame): polygon}}
+    out = dict()
+    for (nid, fr), polygon in polygons.items():
+        out.setdefault(fr, dict())[(nid, fr)] = polygon
+    return out
+
+
+class RunGeometry(object):
+    """
+        Everything the viewer overlays on the frames of a run: nuclei and centrosome positions, the selection,
+        nuclear and cell boundaries. It is read once when the run is selected and then indexed by frame in memory,
+        so that painting a frame does no I/O and no parsing. A new one has to be built when the run is edited.
+    """
+
+    def __init__(self, hdf5file, condition, run):
+        self.hdf5file, self.condition, self.run = hdf5file, condition, run
+        with hdf.file_lock, h5py.File(hdf5file, 'r') as f:
+            if 'pandas_dataframe' not in f['%s/%s/measurements' % (condition, run)]:
+                raise KeyError('No data for selected condition-run.')
+            self.resolution = hdf.raw_resolution(f, condition, run)
+            self.frames = hdf.raw_frame_count(f, condition, run)
+            self.selection = hdf.read_selection(f, condition, run)
+            self._nuclei, self._nuclei_index = hdf.read_frame_table(f, condition, run, kind='nuclei')
+            self._centrosomes, self._centrosomes_index = hdf.read_frame_table(f, condition, run, kind='centrosomes')
+
+            nuclei_bound = hdf.read_polygons(f, condition, run, kind='nuclei')
+            if nuclei_bound is None:
+                # files written before boundaries were stored as polygons
+                df = pd.read_hdf(hdf5file, key='%s/%s/measurements/pandas_dataframe' % (condition, run))
+                df = df.drop_duplicates(['Nuclei', 'Frame'])
+                nuclei_bound = {(n, fr): parse_polygon(b)
+                                for n, fr, b in zip(df['Nuclei'], df['Frame'], df['NuclBound'])}
+            self._nuclei_bound = _by_frame(nuclei_bound)
+
+            # cell boundary and centroid of the nuclei that have one
+            cells = dict()
+            if 'boundary' in f['%s/%s/processed' % (condition, run)]:
+                hlab = hdf.LabHDF5NeXusFile(filename=hdf5file)
+                dfb = hlab.read_processed(condition, run, 'boundary').drop_duplicates(['Nuclei', 'Frame'])
+                cells_bound = hdf.read_polygons(f, condition, run, kind='cells')
+                if cells_bound is None:
+                    cells_bound = {(n, fr): parse_polygon(b)
+                                   for n, fr, b in zip(dfb['Nuclei'], dfb['Frame'], dfb['CellBound'])}
+                for nid, fr, cx, cy in zip(dfb['Nuclei'], dfb['Frame'], dfb['CellX'], dfb['CellY']):
+                    polygon = cells_bound.get((nid, fr))
+                    if polygon is not None and len(polygon) > 0:
+                        cells.setdefault(fr, dict())[nid] = (np.array([cx, cy]), polygon)
+            self._cells = cells
+
+    @staticmethod
+    def _rows(table, index, frame):
+        ix = np.searchsorted(index['frame'], frame)
+        if ix == len(index) or index['frame'][ix] != frame:
+            return table[:0]
+        return table[index['start'][ix]:index['stop'][ix]]
+
+    def frame(self, frame):
+        """ Overlay of a frame, in the dict that CentrosomeImageQLabel.draw_measurements expects. """
+        centrosome_pos = self._rows(self._centrosomes, self._centrosomes_index, frame)
+        return {'resolution': self.resolution,
+                'frames': self.frames,
+                'nuclei': self._rows(self._nuclei, self._nuclei_index, frame),
+                'centrosomes': {'C%03d' % c['track_id']: (c['x'], c['y']) for c in centrosome_pos},
+                'selection': self.selection,
+                'nuclei_bound': self._nuclei_bound.get(frame, dict()),
+                'cells': self._cells.get(frame, dict())}
@@ -1,9 +1,18 @@
 import argparse
 import datetime
+import functools
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
 import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from subprocess import call
 
 import h5py
@@ -12,13 +21,568 @@ import pandas as pd
 import tifffile as tf
 
 from tools import stats
-from imagej.imagej_pandas import ImagejPandas
+from imagej.imagej_pandas import ImagejPandas, parse_polygon
+
+RAW_STACK = 'stack'
+
+
+def raw_frame_count(f, experiment_tag, run):
+    """ Number of frames of a run, for either of the raw layouts. f is an open h5py file. """
+    raw = f['%s/%s/raw' % (experiment_tag, run)]
+    if RAW_STACK in raw:
+        return raw[RAW_STACK].shape[0]
+    return len(raw)
+
+
+def raw_resolution(f, experiment_tag, run):
+    raw = f['%s/%s/raw' % (experiment_tag, run)]
+    if RAW_STACK in raw:
+        return raw[RAW_STACK].attrs['resolution']
+    return raw['%03d' % 0].attrs['resolution']
+
+
+def read_raw(f, experiment_tag, run, frame=None, channel=None):
+    """
+        Reads raw image data from an open h5py file, for either of the raw layouts.
+        Channels are numbered from 1 as in the per-frame layout (channel-1, channel-2, ...).
+        Returns a (Y, X) image when both frame and channel are given, a (C, Y, X) stack for a whole frame,
+        a (T, Y, X) stack for a whole channel or (T, C, Y, X) if none are given.
+    """
+    raw = f['%s/%s/raw' % (experiment_tag, run)]
+    if RAW_STACK in raw:
+        t = slice(None) if frame is None else frame
+        c = slice(None) if channel is None else channel - 1
+        return raw[RAW_STACK][t, c]
+
+    frames = range(len(raw)) if frame is None else [frame]
+    out = list()
+    for fr in frames:
+        nxframe = raw['%03d' % fr]
+        if channel is None:
+            n_ch = len([k for k in nxframe if k[:8] == 'channel-'])
+            out.append(np.stack([nxframe['channel-%d' % (c + 1)][:] for c in range(n_ch)]))
+        else:
+            out.append(nxframe['channel-%d' % channel][:])
+    return out[0] if frame is not None else np.stack(out)
+
+
+PREVIEW_PERCENTILES = (0.5, 99.5)
+
+
+def _halve(img):
+    # (C, Y, X) uint8 image downsampled by averaging 2x2 blocks
+    c, y, x = img.shape
+    blocks = img[:, :y - y % 2, :x - x % 2].reshape(c, y // 2, 2, x // 2, 2)
+    return blocks.mean(axis=(2, 4)).astype(np.uint8)
+
+
+def write_preview(f, experiment_tag, run, levels=2, percentiles=PREVIEW_PERCENTILES, sample=16):
+    """
+        Builds the preview tier of a run used by the viewers: uint8 images of every frame and channel halved 1 to
+        levels times, stored in preview/level-<l> as gzip compressed (T, C, Y, X) datasets chunked per frame and
+        channel. There is no full size level, as that would be a copy of the raw images; viewers scale level 1 back
+        to the (Y, X) shape kept in the attributes of preview. Intensities are mapped to 0-255 between the low and
+        high percentiles of each channel, taken over a sample of frames so that brightness doesn't flicker from
+        frame to frame.
+    """
+    nframes = raw_frame_count(f, experiment_tag, run)
+    if nframes == 0:
+        return
+    sampled = np.unique(np.linspace(0, nframes - 1, min(nframes, sample)).astype(int))
+    pixels = np.stack([read_raw(f, experiment_tag, run, frame=fr)[:, ::4, ::4] for fr in sampled])
+    low, high = np.percentile(pixels, percentiles, axis=(0, 2, 3))
+    scale = (255.0 / np.maximum(high - low, 1))[:, None, None]
+    low = low[:, None, None]
+
+    nxrun = f['%s/%s' % (experiment_tag, run)]
+    if 'preview' in nxrun: del nxrun['preview']
+    nxprev = nxrun.create_group('preview')
+    nxprev.attrs['NX_class'] = 'NXdata'
+    nxprev.attrs['percentiles'] = percentiles
+    nxprev.attrs['low'] = low.ravel()
+    nxprev.attrs['high'] = high
+
+    for fr in range(nframes):
+        img = np.clip((read_raw(f, experiment_tag, run, frame=fr) - low) * scale, 0, 255).astype(np.uint8)
+        if fr == 0: nxprev.attrs['shape'] = img.shape[1:]
+        for l in range(1, levels + 1):
+            img = _halve(img)
+            name = 'level-%d' % l
+            if name not in nxprev:
+                c, y, x = img.shape
+                nxprev.create_dataset(name, shape=(nframes, c, y, x), dtype=np.uint8, chunks=(1, 1, y, x),
+                                      compression='gzip')
+            nxprev[name][fr] = img
+
+
+def read_preview(f, experiment_tag, run, frame, channel, level=1):
+    """
+        uint8 (Y, X) preview image of a frame and channel (numbered from 1, as in read_raw), halved level times.
+        Returns None if the run has no preview at that level; analysis code should use read_raw instead.
+    """
+    name = '%s/%s/preview/level-%d' % (experiment_tag, run, level)
+    if name not in f:
+        return None
+    return f[name][frame, channel - 1]
+
+
+def read_gabor_response(f, experiment_tag, run, frame):
+    """ Gabor response of a frame as stored by write_gabor_response, or None if it wasn't computed yet. """
+    nxproc = f['%s/%s/processed' % (experiment_tag, run)]
+    if 'gabor_response' not in nxproc or not nxproc['gabor_response/computed'][frame]:
+        return None
+    return nxproc['gabor_response/response'][frame]
+
+
+def write_gabor_response(f, experiment_tag, run, frame, response):
+    """
+        Stores the 8-bit gabor response of a frame (see cell.gabor_response) in processed/gabor_response, a (T, Y, X)
+        dataset chunked per frame, so that the cell segmentation can be redone with another threshold without
+        filtering the raw images again.
+    """
+    nxproc = f['%s/%s/processed' % (experiment_tag, run)]
+    if 'gabor_response' not in nxproc:
+        nframes = raw_frame_count(f, experiment_tag, run)
+        nxgab = nxproc.create_group('gabor_response')
+        nxgab.attrs['NX_class'] = 'NXdata'
+        nxgab.create_dataset('response', shape=(nframes,) + response.shape, dtype=np.uint8,
+                             chunks=(1,) + response.shape, compression='gzip')
+        nxgab.create_dataset('computed', shape=(nframes,), dtype=bool)
+    nxgab = nxproc['gabor_response']
+    nxgab['response'][frame] = response
+    nxgab['computed'][frame] = True
+
+
+TRACK_DTYPE = np.dtype([('track_id', np.int32), ('frame', np.int32), ('x', np.float64), ('y', np.float64)])
+INDEX_DTYPE = lambda key: np.dtype([(key, np.int32), ('start', np.int64), ('stop', np.int64)])
+_TRACK_FORMAT = {'nuclei': 'N%02d', 'centrosomes': 'C%03d'}
+
+
+def _offsets(keys, key_name):
+    # keys must be sorted; returns a (key, start, stop) row per distinct key
+    uniq, start = np.unique(keys, return_index=True)
+    index = np.zeros(len(uniq), dtype=INDEX_DTYPE(key_name))
+    index[key_name] = uniq
+    index['start'] = start
+    index['stop'] = np.append(start[1:], len(keys))
+    return index
+
+
+def write_tracks(nxmeas, kind, track_id, frame, x, y):
+    """
+        Stores the tracks of a run as a flat table of (track_id, frame, x, y) rows in measurements/tracks/<kind>.
+        table is sorted by track and frame_table by frame, each with an index of (key, start, stop) offsets, so that
+        a whole track or all positions of a frame are one contiguous slice.
+    """
+    rows = np.zeros(len(track_id), dtype=TRACK_DTYPE)
+    rows['track_id'], rows['frame'], rows['x'], rows['y'] = track_id, frame, x, y
+
+    nxtrk = nxmeas.require_group('tracks').create_group(kind)
+    nxtrk.attrs['NX_class'] = 'NXdata'
+    by_track = rows[np.lexsort((rows['frame'], rows['track_id']))]
+    by_frame = rows[np.lexsort((rows['track_id'], rows['frame']))]
+    nxtrk.create_dataset('table', data=by_track)
+    nxtrk.create_dataset('track_index', data=_offsets(by_track['track_id'], 'track_id'))
+    nxtrk.create_dataset('frame_table', data=by_frame)
+    nxtrk.create_dataset('frame_index', data=_offsets(by_frame['frame'], 'frame'))
+
+
+def _legacy_tracks(f, experiment_tag, run, kind):
+    # files written before the columnar layout keep one group per track with a (frame, x, y) pos dataset
+    groups = f['%s/%s/measurements/%s' % (experiment_tag, run, kind)]
+    tables = list()
+    for name in groups:
+        pos = groups[name]['pos'][()]
+        rows = np.zeros(len(pos), dtype=TRACK_DTYPE)
+        rows['track_id'] = int(name[1:])
+        rows['frame'], rows['x'], rows['y'] = pos[:, 0], pos[:, 1], pos[:, 2]
+        tables.append(rows)
+    return np.concatenate(tables) if tables else np.zeros(0, dtype=TRACK_DTYPE)
+
+
+def _tracks_group(f, experiment_tag, run, kind):
+    meas = f['%s/%s/measurements' % (experiment_tag, run)]
+    return meas['tracks/%s' % kind] if 'tracks/%s' % kind in meas else None
+
+
+def track_ids(f, experiment_tag, run, kind='centrosomes'):
+    """ Sorted ids of the nuclei or centrosome tracks of a run. f is an open h5py file. """
+    nxtrk = _tracks_group(f, experiment_tag, run, kind)
+    if nxtrk is None:
+        return sorted([int(n[1:]) for n in f['%s/%s/measurements/%s' % (experiment_tag, run, kind)]])
+    return nxtrk['track_index']['track_id'].tolist()
+
+
+def track_names(f, experiment_tag, run, kind='centrosomes'):
+    """ Track ids formatted as in the rest of the file, e.g. N01 or C001. """
+    return [_TRACK_FORMAT[kind] % i for i in track_ids(f, experiment_tag, run, kind=kind)]
+
+
+def read_track(f, experiment_tag, run, track_id, kind='centrosomes'):
+    """ All (track_id, frame, x, y) rows of one track, sorted by frame. """
+    nxtrk = _tracks_group(f, experiment_tag, run, kind)
+    if nxtrk is None:
+        rows = _legacy_tracks(f, experiment_tag, run, kind)
+        rows = rows[rows['track_id'] == track_id]
+        return rows[np.argsort(rows['frame'])]
+    index = nxtrk['track_index'][()]
+    ix = np.searchsorted(index['track_id'], track_id)
+    if ix == len(index) or index['track_id'][ix] != track_id:
+        return np.zeros(0, dtype=TRACK_DTYPE)
+    return nxtrk['table'][index['start'][ix]:index['stop'][ix]]
+
+
+def read_frame_positions(f, experiment_tag, run, frame, kind='centrosomes'):
+    """ The (track_id, frame, x, y) rows of every track present in a frame, sorted by track. """
+    nxtrk = _tracks_group(f, experiment_tag, run, kind)
+    if nxtrk is None:
+        rows = _legacy_tracks(f, experiment_tag, run, kind)
+        rows = rows[rows['frame'] == frame]
+        return rows[np.argsort(rows['track_id'])]
+    index = nxtrk['frame_index'][()]
+    ix = np.searchsorted(index['frame'], frame)
+    if ix == len(index) or index['frame'][ix] != frame:
+        return np.zeros(0, dtype=TRACK_DTYPE)
+    return nxtrk['frame_table'][index['start'][ix]:index['stop'][ix]]
+
+
+def read_frame_table(f, experiment_tag, run, kind='centrosomes'):
+    """ All (track_id, frame, x, y) rows of a run sorted by frame, along with the (frame, start, stop) index. """
+    nxtrk = _tracks_group(f, experiment_tag, run, kind)
+    if nxtrk is None:
+        rows = _legacy_tracks(f, experiment_tag, run, kind)
+        rows = rows[np.lexsort((rows['track_id'], rows['frame']))]
+        return rows, _offsets(rows['frame'], 'frame')
+    return nxtrk['frame_table'][()], nxtrk['frame_index'][()]
+
+
+POLYGON_INDEX_DTYPE = np.dtype([('nucleus_id', np.int32), ('frame', np.int32), ('start', np.int64), ('stop', np.int64)])
+# nuclear boundaries come with the measurements, cell boundaries are computed afterwards from the gabor threshold
+_POLYGON_PARENT = {'nuclei': 'measurements', 'cells': 'processed'}
+
+
+def _polygons_group(f, experiment_tag, run, kind):
+    parent = f['%s/%s/%s' % (experiment_tag, run, _POLYGON_PARENT[kind])]
+    return parent['polygons/%s' % kind] if 'polygons/%s' % kind in parent else None
+
+
+def write_polygons(f, experiment_tag, run, kind, nucleus_id, frame, polygons, nuclei=None):
+    """
+        Stores boundary polygons of a run as a ragged float32 array of (x, y) vertices in <parent>/polygons/<kind>,
+        with an index of (nucleus_id, frame, start, stop) offsets sorted by nucleus and frame. Polygons that are None
+        are skipped. If nuclei is given, only the polygons of those nuclei are replaced and the rest are kept.
+    """
+    keep = [(n, fr, p) for n, fr, p in zip(nucleus_id, frame, polygons) if p is not None]
+    nxpoly = _polygons_group(f, experiment_tag, run, kind)
+    if nuclei is not None and nxpoly is not None:
+        index, coords = nxpoly['index'][()], nxpoly['coords'][()]
+        old = index[~np.isin(index['nucleus_id'], _as_list(nuclei))]
+        keep += [(r['nucleus_id'], r['frame'], coords[r['start']:r['stop']]) for r in old]
+
+    keep.sort(key=lambda k: (k[0], k[1]))
+    index = np.zeros(len(keep), dtype=POLYGON_INDEX_DTYPE)
+    index['nucleus_id'] = [k[0] for k in keep]
+    index['frame'] = [k[1] for k in keep]
+    index['stop'] = np.cumsum([len(k[2]) for k in keep])
+    index['start'] = index['stop'] - [len(k[2]) for k in keep]
+    coords = np.concatenate([k[2] for k in keep]).astype(np.float32) if keep else np.zeros((0, 2), dtype=np.float32)
+
+    if nxpoly is not None:
+        del nxpoly.parent[kind]
+    nxparent = f['%s/%s/%s' % (experiment_tag, run, _POLYGON_PARENT[kind])]
+    nxpoly = nxparent.require_group('polygons').create_group(kind)
+    nxpoly.attrs['NX_class'] = 'NXdata'
+    nxpoly.create_dataset('coords', data=coords)
+    nxpoly.create_dataset('index', data=index)
+
+
+def read_polygons(f, experiment_tag, run, kind='nuclei', nuclei=None, frame=None):
+    """
+        Boundary polygons of a run as a dict of (nucleus_id, frame): (k, 2) float32 array, optionally of some nuclei
+        or a frame. Returns None if the run has no polygons stored, e.g. files written before they were.
+    """
+    nxpoly = _polygons_group(f, experiment_tag, run, kind)
+    if nxpoly is None:
+        return None
+    index = nxpoly['index'][()]
+    if nuclei is not None:
+        index = index[np.isin(index['nucleus_id'], _as_list(nuclei))]
+    if frame is not None:
+        index = index[index['frame'] == frame]
+    if len(index) == 0:
+        return dict()
+
+    # one read spanning all the requested polygons, unless they are scattered over most of the array
+    lo, hi = index['start'].min(), index['stop'].max()
+    if hi - lo <= 4 * np.sum(index['stop'] - index['start']):
+        coords = nxpoly['coords'][lo:hi]
+        return {(n, fr): coords[start - lo:stop - lo] for n, fr, start, stop in index.tolist()}
+    coords = nxpoly['coords']
+    return {(n, fr): coords[start:stop] for n, fr, start, stop in index.tolist()}
+
+
+SELECTION_DTYPE = np.dtype([('centrosome_id', np.int32), ('nucleus_id', np.int32), ('label', np.int8)])
+SELECTION_VERSION = 1
+SELECTION_LABELS = 'AB'
+
+
+class Selection(object):
+    """
+        Centrosomes selected in a run: one (centrosome_id, nucleus_id, label) row per centrosome, where label is 0 for
+        group A and 1 for group B. A centrosome belongs to at most one nucleus.
+    """
+
+    def __init__(self, rows=None):
+        rows = np.zeros(0, dtype=SELECTION_DTYPE) if rows is None else np.asarray(rows, dtype=SELECTION_DTYPE)
+        self.rows = np.sort(rows, order='centrosome_id')
+        self._of_centrosome = dict(zip(self.rows['centrosome_id'].tolist(),
+                                       zip(self.rows['nucleus_id'].tolist(), self.rows['label'].tolist())))
+
+    @staticmethod
+    def _ids(centrosomes):
+        # accepts ids or names like C001, either alone or in a list
+        return np.array([int(c[1:]) if isinstance(c, (str, bytes)) else int(c)
+                         for c in np.atleast_1d(centrosomes)], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, centrosome):
+        return int(self._ids(centrosome)[0]) in self._of_centrosome
+
+    def nucleus_of(self, centrosome):
+        """ (nucleus_id, label) of a selected centrosome, or None. """
+        return self._of_centrosome.get(int(self._ids(centrosome)[0]))
+
+    @property
+    def nuclei(self):
+        return np.unique(self.rows['nucleus_id']).tolist()
+
+    def centrosomes(self, nucleus_id, label=None):
+        ix = self.rows['nucleus_id'] == nucleus_id
+        if label is not None:
+            ix &= self.rows['label'] == label
+        return self.rows['centrosome_id'][ix].tolist()
+
+    def associate(self, centrosomes, nucleus_id, label):
+        centr = self._ids(centrosomes)
+        new = np.zeros(len(centr), dtype=SELECTION_DTYPE)
+        new['centrosome_id'], new['nucleus_id'], new['label'] = centr, nucleus_id, label
+        keep = self.rows[~np.isin(self.rows['centrosome_id'], centr)]
+        return Selection(np.concatenate([keep, new]))
+
+    def delete(self, centrosomes=None, nuclei=None):
+        ix = np.ones(len(self.rows), dtype=bool)
+        if centrosomes is not None:
+            ix &= np.isin(self.rows['centrosome_id'], self._ids(centrosomes))
+        if nuclei is not None:
+            ix &= np.isin(self.rows['nucleus_id'], np.atleast_1d(nuclei))
+        return Selection(self.rows[~ix])
+
+    def to_dataframe(self):
+        return pd.DataFrame({'Centrosome': self.rows['centrosome_id'], 'Nuclei': self.rows['nucleus_id'],
+                             'CentrLabel': np.array(list(SELECTION_LABELS))[self.rows['label']]})
+
+
+def _legacy_nuclei(sel):
+    # nuclei groups of the old selection/Nxx/A|B/Cyyy layout; old files keep pandas tables in the same group
+    return [name for name in sel if re.match(r'N\d+$', name) and isinstance(sel[name], h5py.Group) and
+            all(isinstance(sel[name].get(group), h5py.Group) for group in SELECTION_LABELS)]
+
+
+def read_selection(f, experiment_tag, run):
+    """ Selection of a run; files that still keep it as selection/Nxx/A|B/Cyyy groups are read too. """
+    sel = f['%s/%s/selection' % (experiment_tag, run)]
+    if 'centrosomes' in sel:
+        return Selection(sel['centrosomes'][()])
+    rows = list()
+    for nuclei_str in _legacy_nuclei(sel):
+        for label, group in enumerate(SELECTION_LABELS):
+            rows.extend([(int(c[1:]), int(nuclei_str[1:]), label) for c in sel['%s/%s' % (nuclei_str, group)]])
+    return Selection(np.array(rows, dtype=SELECTION_DTYPE))
+
+
+def write_selection(f, experiment_tag, run, selection):
+    sel = f['%s/%s/selection' % (experiment_tag, run)]
+    old = read_selection(f, experiment_tag, run).rows
+    changed = len(old) != len(selection.rows) or not np.array_equal(np.sort(old), np.sort(selection.rows))
+    if not changed and 'centrosomes' in sel and not _legacy_nuclei(sel):
+        return
+    # migrate the per-nucleus groups of older files, keeping their gabor thresholds
+    for nuclei_str in _legacy_nuclei(sel):
+        if 'gabor_threshold' in sel[nuclei_str].attrs:
+            sel.attrs['%s_gabor_threshold' % nuclei_str] = sel[nuclei_str].attrs['gabor_threshold']
+        del sel[nuclei_str]
+    if 'centrosomes' in sel:
+        del sel['centrosomes']
+    sel.create_dataset('centrosomes', data=selection.rows, dtype=SELECTION_DTYPE)
+    sel.attrs['version'] = SELECTION_VERSION
+    # lets stale processed tables be told apart, see LabHDF5NeXusFile.stale_runs
+    if changed or 'revision' not in sel.attrs:
+        sel.attrs['revision'] = sel.attrs.get('revision', 0) + 1
+
+
+def relabel_selection(measured, selection):
+    """
+        Keeps the selected centrosomes of a measurements dataframe, tagging each one with the nucleus and the label
+        (A or B) given in the GUI.
+    """
+    sel = selection.to_dataframe().set_index('Centrosome')
+    measured = measured[measured['Centrosome'].isin(sel.index)].copy()
+    measured['Nuclei'] = measured['Centrosome'].map(sel['Nuclei']).astype(measured['Nuclei'].dtype)
+    measured['CentrLabel'] = measured['Centrosome'].map(sel['CentrLabel'])
+    return measured
+
+
+def gabor_threshold(f, experiment_tag, run, nuc_id):
+    sel = f['%s/%s/selection' % (experiment_tag, run)]
+    key = 'N%02d_gabor_threshold' % nuc_id
+    if key in sel.attrs:
+        return sel.attrs[key]
+    if 'N%02d' % nuc_id in sel and 'gabor_threshold' in sel['N%02d' % nuc_id].attrs:
+        return sel['N%02d' % nuc_id].attrs['gabor_threshold']
+    return None
+
+
+def set_gabor_threshold(f, experiment_tag, run, nuc_id, threshold):
+    sel = f['%s/%s/selection' % (experiment_tag, run)]
+    if _legacy_nuclei(sel):
+        # migrated first, or the threshold of the old group would win over this one
+        write_selection(f, experiment_tag, run, read_selection(f, experiment_tag, run))
+    key = 'N%02d_gabor_threshold' % nuc_id
+    if key not in sel.attrs or sel.attrs[key] != threshold:
+        sel.attrs[key] = threshold
+
+
+def read_tiff_metadata(tif):
+    """ Reads the hyperstack dimensions and pixel calibration of an ImageJ tiff without touching pixel data. """
+    if tif.is_imagej is None:
+        return None
+
+    sizeT, channels = tif.pages[0].imagej_tags.frames, tif.pages[0].imagej_tags.channels
+    sizeZ, sizeX, sizeY = 1, tif.pages[0].image_width, tif.pages[0].image_length
+    logging.info('N of frames=%d channels=%d, sizeZ=%d, sizeX=%d, sizeY=%d' % \
+                 (sizeT, channels, sizeZ, sizeX, sizeY))
+
+    res = 'n/a'
+    if tif.pages[0].resolution_unit == 'centimeter':
+        # asuming square pixels
+        xr = tif.pages[0].x_resolution
+        res = float(xr[0]) / float(xr[1])  # pixels per cm
+        res = res / 1e4  # pixels per um
+    elif tif.pages[0].imagej_tags.unit == 'micron':
+        # asuming square pixels
+        xr = tif.pages[0].x_resolution
+        res = float(xr[0]) / float(xr[1])  # pixels per um
+
+    return {'frames': sizeT, 'channels': channels, 'width': sizeX, 'height': sizeY, 'resolution': res}
+
+
+def iter_tiff_frames(tif, tiffpath, meta):
+    """
+        Yields the frames of an ImageJ hyperstack as (C, Y, X) arrays, one at a time.
+        The contiguous ImageJ payload is memory-mapped when possible; otherwise each page is decoded on its own.
+        Only if neither is possible the whole hyperstack is decoded in memory.
+    """
+    shape = (meta['frames'], meta['channels'], meta['height'], meta['width'])
+    try:
+        stack = tf.memmap(tiffpath, mode='r')
+    except ValueError:
+        stack = None
+
+    if stack is not None and stack.size == np.prod(shape):
+        stack = stack.reshape(shape)
+        for t in range(shape[0]):
+            yield np.array(stack[t])
+        del stack
+    elif len(tif.pages) == shape[0] * shape[1]:
+        for t in range(shape[0]):
+            yield np.stack([tif.pages[t * shape[1] + c].asarray() for c in range(shape[1])])
+    else:
+        logging.warning('%s is neither contiguous nor one page per plane, decoding it in memory.' % tiffpath)
+        stack = tif.pages[0].asarray().reshape(shape)
+        for t in range(shape[0]):
+            yield stack[t]
+
+
+# serializes access to the NeXus files between threads, e.g. while a viewer reads frames in the background;
+# h5py and PyTables can't have the file open for reading in one thread and for writing in another. It is held
+# while the file is open, for each read or write or for a session, never while processing the data read
+file_lock = threading.RLock()
+
+
+def _operation(method):
+    # names the outermost LabHDF5NeXusFile call, so that file opens are accounted to it
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        outer = self._operation is None
+        if outer: self._operation = method.__name__
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            if outer: self._operation = None
+
+    return wrapper
+
+
+class _Session(object):
+    """
+        Open handles on the NeXus file, shared by every LabHDF5NeXusFile call made while the session is active.
+        h5py and PyTables bundle their own HDF5 libraries and can't both hold the file open for writing, so the
+        session keeps open whichever of the two handles was used last and switches only when the other is needed.
+        Handles are opened with mode, 'r' for sessions that only read.
+    """
+
+    def __init__(self, hdf5f, mode='a'):
+        self.hdf5f = hdf5f
+        self.mode = mode
+        self._h5 = None
+        self._store = None
+        self.h5_depth = 0
+
+    @property
+    def h5(self):
+        if self._h5 is None:
+            self._close_store()
+            self.hdf5f._count_open()
+            self._h5 = h5py.File(self.hdf5f.filename, self.mode)
+        return self._h5
+
+    @property
+    def store(self):
+        if self.h5_depth > 0:
+            raise RuntimeError('pandas access while an h5py handle is in use.')
+        if self._store is None:
+            self._close_h5()
+            self.hdf5f._count_open()
+            self._store = pd.HDFStore(self.hdf5f.filename, mode=self.mode)
+        return self._store
+
+    def _close_h5(self):
+        if self._h5 is not None:
+            self._h5.flush()
+            self._h5.close()
+            self._h5 = None
+
+    def _close_store(self):
+        if self._store is not None:
+            self._store.flush()
+            self._store.close()
+            self._store = None
+
+    def close(self):
+        self._close_h5()
+        self._close_store()
 
 
 class LabHDF5NeXusFile():
     def __init__(self, filename='fabio_data_hochegger_lab.nexus.hdf5', imagesfile=None, fileflag='r'):
         self.filename = filename
         self.imagefile = imagesfile
+        self._session = None
+        self._operation = None
+        # number of times the file was opened, by operation
+        self.file_opens = Counter()
 
         # open the HDF5 NeXus file
         if fileflag == 'w':
@@ -34,11 +598,79 @@ class LabHDF5NeXusFile():
                 f.attrs['HDF5_Version'] = h5py.version.hdf5_version
                 f.attrs['h5py_version'] = h5py.version.version
 
-    def add_experiment(self, group, experiment_tag, timestamp=None):
+    @contextmanager
+    def session(self, mode='a'):
+        """
+            Keeps the file open for a batch of operations, which then share the handle instead of opening and
+            closing the file each. Everything is flushed once, when the session ends. Sessions that only read
+            should pass mode='r', so that the file isn't opened for writing. The file stays locked for other
+            threads until the session ends, so sessions should group reads and writes, not processing.
+
+                with hdf5.session():
+                    hdf5.delete_association(...)
+                    hdf5.associate_centrosome_with_nuclei(...)
+        """
+        if self._session is not None:
+            if mode != 'r' and self._session.mode == 'r':
+                raise RuntimeError('writing session inside a read-only one.')
+            yield self
+            return
+        with file_lock:
+            self._session = _Session(self, mode=mode)
+            try:
+                yield self
+            finally:
+                self._session.close()
+                self._session = None
+
+    def _count_open(self):
+        self.file_opens[self._operation or 'session'] += 1
+
+    @contextmanager
+    def _h5(self, mode='r'):
+        if self._session is not None:
+            if mode != 'r' and self._session.mode == 'r':
+                raise RuntimeError('writing in a read-only session.')
+            self._session.h5_depth += 1
+            try:
+                yield self._session.h5
+            finally:
+                self._session.h5_depth -= 1
+        else:
+            with file_lock:
+                self._count_open()
+                with h5py.File(self.filename, mode) as f:
+                    yield f
+
+    @contextmanager
+    def _pd(self, mode='r'):
+        if self._session is not None:
+            if mode != 'r' and self._session.mode == 'r':
+                raise RuntimeError('writing in a read-only session.')
+            yield self._session.store
+        else:
+            with file_lock:
+                self._count_open()
+                with pd.HDFStore(self.filename, mode=mode) as store:
+                    yield store
+
+    def _read_hdf(self, key, nuclei=None, frame=None, centrosomes=None):
+        with self._pd('r') as store:
+            return _select(store, key, nuclei=nuclei, frame=frame, centrosomes=centrosomes)
+
+    def _to_hdf(self, df, key, table=False):
+        with self._pd('a') as store:
+            if table:
+                _put_table(store, key, df)
+            else:
+                store.put(key, df)
+
+    @_operation
+    def add_experiment(self, group, experiment_tag, timestamp=None, clear_raw=False):
         gr = '%s/%s' % (group, experiment_tag)
         timestamp = timestamp if timestamp is not None else datetime.datetime.now().isoformat()
 
-        with h5py.File(self.filename, 'a') as f:
+        with self._h5('a') as f:
             if gr in f: del f[gr]
 
             # create the NXentry experiment group
@@ -56,313 +688,494 @@ class LabHDF5NeXusFile():
             nxentry_proc = nxentry.create_group('processed')
             nxentry_proc.attrs['NX_class'] = 'NXgroup'
 
-        with h5py.File(self.imagefile, 'a') as i:
-            rawgr = '%s/%s/raw' % (group, experiment_tag)
-            # create the NXentry experiment group
-            nxentry = i.require_group(rawgr)
-            nxentry.attrs['NX_class'] = 'NXentry'
-            nxentry.attrs['datetime'] = timestamp
-            i[rawgr].attrs['NX_class'] = 'NXgroup'
+        if self.imagefile is not None:
+            self._count_open()
+            with h5py.File(self.imagefile, 'a') as i:
+                rawgr = '%s/%s/raw' % (group, experiment_tag)
+                if clear_raw and rawgr in i: del i[rawgr]
+                # create the NXentry experiment group
+                nxentry = i.require_group(rawgr)
+                nxentry.attrs['NX_class'] = 'NXentry'
+                nxentry.attrs['datetime'] = timestamp
+                i[rawgr].attrs['NX_class'] = 'NXgroup'
 
-    def add_tiff_sequence(self, tiffpath, experiment_tag, run):
+    @_operation
+    def add_tiff_sequence(self, tiffpath, experiment_tag, run, layout='frames', compression='gzip', decoded=None):
+        """
+            Adds the raw images of a run. With layout='frames' every frame is stored in its own group with one dataset
+            per channel (raw/000/channel-1, ...). With layout='stack' the whole movie is stored in a single
+            (T, C, Y, X) dataset (raw/stack), chunked per frame and channel and compressed with the given filter.
+            If the tiff was already decoded elsewhere, its (metadata, frames) can be passed in decoded.
+        """
         _grp = '%s/%s/raw' % (experiment_tag, run)
         # open the HDF5 NeXus file
         if self.imagefile is None:
-            f = h5py.File(self.filename, 'a')
+            with self._h5('a') as f:
+                self._add_raw(f[_grp], tiffpath, layout, compression, decoded)
         else:
-            f = h5py.File(self.imagefile, 'a')
+            self._count_open()
+            with h5py.File(self.imagefile, 'a') as f:
+                self._add_raw(f[_grp], tiffpath, layout, compression, decoded)
+
+            # relinked even if the images file already had the frames, add_experiment left an empty group in its place
+            with self._h5('a') as f:
+                if f.get(_grp, getlink=True) is not None:
+                    del f[_grp]
+                f[_grp] = h5py.ExternalLink(self.imagefile, _grp)
 
+    def _add_raw(self, nxdata, tiffpath, layout, compression, decoded):
         # update the NXentry group
-        nxdata = f[_grp]
         nxdata.attrs['NX_class'] = 'NXdata'
         nxdata.attrs['signal'] = 'Y'  # Y axis of default plot
         nxdata.attrs['axes'] = 'X'  # X axis of default plot
         nxdata.attrs['units'] = 'um'  # default units
 
+        existing = (RAW_STACK if RAW_STACK in nxdata else 'frames') if len(nxdata) > 0 else None
+        if existing is not None and existing != layout:
+            logging.info('raw images stored as %s, rewriting them as %s.' % (existing, layout))
+            for key in list(nxdata.keys()):
+                del nxdata[key]
+
         nframes = len(nxdata.items())
-        if nframes == 0:
+        if nframes == 0 and decoded is not None:
+            meta, frames = decoded
+            if meta is not None and meta['frames'] > 1:
+                self._write_raw(nxdata, frames, meta, layout=layout, compression=compression)
+        elif nframes == 0:
             with tf.TiffFile(tiffpath, fastij=True) as tif:
-                if tif.is_imagej is not None:
-                    sizeT, channels = tif.pages[0].imagej_tags.frames, tif.pages[0].imagej_tags.channels
-                    sizeZ, sizeX, sizeY = 1, tif.pages[0].image_width, tif.pages[0].image_length
-                    logging.info('N of frames=%d channels=%d, sizeZ=%d, sizeX=%d, sizeY=%d' % \
-                                 (sizeT, channels, sizeZ, sizeX, sizeY))
-
-                    res = 'n/a'
-                    if tif.pages[0].resolution_unit == 'centimeter':
-                        # asuming square pixels
-                        xr = tif.pages[0].x_resolution
-                        res = float(xr[0]) / float(xr[1])  # pixels per cm
-                        res = res / 1e4  # pixels per um
-                    elif tif.pages[0].imagej_tags.unit == 'micron':
-                        # asuming square pixels
-                        xr = tif.pages[0].x_resolution
-                        res = float(xr[0]) / float(xr[1])  # pixels per um
-
-                    if sizeT > 1:
-                        p1a = tif.pages[0].asarray().reshape([sizeT, channels, sizeX, sizeY])
-                        for i in range(sizeT):
-                            # create a NXentry frame group
-                            nxframe = nxdata.create_group('%03d' % i)
-                            nxframe.attrs['units'] = 'um'
-                            nxframe.attrs['resolution'] = res
-                            nxframe.attrs['long_name'] = 'image um (micrometers)'  # suggested X axis plot label
-
-                            # save XY data
-                            ch1 = nxframe.create_dataset('channel-1', data=p1a[i][0], dtype=np.uint16)
-                            ch2 = nxframe.create_dataset('channel-2', data=p1a[i][1], dtype=np.uint16)
-                            ch3 = nxframe.create_dataset('channel-3', data=p1a[i][2], dtype=np.uint16)
-                            for ch in [ch1, ch2, ch3]:
-                                ch.attrs['CLASS'] = np.string_('IMAGE')
-                                ch.attrs['IMAGE_SUBCLASS'] = np.string_('IMAGE_GRAYSCALE')
-                                ch.attrs['IMAGE_VERSION'] = np.string_('1.2')
-
-        f.close()
-
-        if self.imagefile is not None and nframes == 0:
-            with h5py.File(self.filename, 'a') as f:
-                del f[_grp]
-                f[_grp] = h5py.ExternalLink(self.imagefile, _grp)
+                meta = read_tiff_metadata(tif)
+                if meta is not None and meta['frames'] > 1:
+                    frames = iter_tiff_frames(tif, tiffpath, meta)
+                    self._write_raw(nxdata, frames, meta, layout=layout, compression=compression)
+        return nframes
+
+    @staticmethod
+    def _write_raw(nxdata, frames, meta, layout='frames', compression='gzip'):
+        # frames is an iterable of (C, Y, X) arrays, written as they come so only one frame is held at a time
+        sizeT, channels, sizeY, sizeX = meta['frames'], meta['channels'], meta['height'], meta['width']
+        res = meta['resolution']
+        if layout == 'stack':
+            nxstack = nxdata.create_dataset(RAW_STACK, shape=(sizeT, channels, sizeY, sizeX),
+                                            dtype=np.uint16, chunks=(1, 1, sizeY, sizeX),
+                                            compression=compression)
+            nxstack.attrs['units'] = 'um'
+            nxstack.attrs['resolution'] = res
+            nxstack.attrs['long_name'] = 'image um (micrometers)'
+            nxstack.attrs['axes'] = np.string_('T,C,Y,X')
+            for i, frame in enumerate(frames):
+                nxstack[i] = frame
+        else:
+            for i, frame in enumerate(frames):
+                # create a NXentry frame group
+                nxframe = nxdata.create_group('%03d' % i)
+                nxframe.attrs['units'] = 'um'
+                nxframe.attrs['resolution'] = res
+                nxframe.attrs['long_name'] = 'image um (micrometers)'  # suggested X axis plot label
 
-    def add_measurements(self, csvpath, experiment_tag, run):
-        dfc = ImagejPandas(csvpath)
-        with h5py.File(self.filename, 'a') as f:
+                # save XY data
+                ch1 = nxframe.create_dataset('channel-1', data=frame[0], dtype=np.uint16)
+                ch2 = nxframe.create_dataset('channel-2', data=frame[1], dtype=np.uint16)
+                ch3 = nxframe.create_dataset('channel-3', data=frame[2], dtype=np.uint16)
+                for ch in [ch1, ch2, ch3]:
+                    ch.attrs['CLASS'] = np.string_('IMAGE')
+                    ch.attrs['IMAGE_SUBCLASS'] = np.string_('IMAGE_GRAYSCALE')
+                    ch.attrs['IMAGE_VERSION'] = np.string_('1.2')
+
+    @_operation
+    def add_preview(self, experiment_tag, run, levels=2, force=False):
+        """ Builds the uint8 preview images of a run if they are missing, or always if force is set. """
+        with self._h5('a') as f:
+            if force or 'preview' not in f['%s/%s' % (experiment_tag, run)]:
+                write_preview(f, experiment_tag, run, levels=levels)
+
+    @_operation
+    def run_manifest(self, experiment_tag, run):
+        if self._session is None and not os.path.isfile(self.filename): return None
+        with self._h5('r') as f:
+            gr = '%s/%s' % (experiment_tag, run)
+            if gr not in f or 'manifest' not in f[gr].attrs:
+                return None
+            return json.loads(f[gr].attrs['manifest'])
+
+    @_operation
+    def set_run_manifest(self, experiment_tag, run, manifest):
+        # written last, so a run without manifest is one whose ingestion didn't finish
+        with self._h5('a') as f:
+            f['%s/%s' % (experiment_tag, run)].attrs['manifest'] = json.dumps(manifest)
+
+    @_operation
+    def read_frame(self, experiment_tag, run, frame=None, channel=None):
+        with self._h5('r') as f:
+            return read_raw(f, experiment_tag, run, frame=frame, channel=channel)
+
+    @_operation
+    def track(self, experiment_tag, run, track_id, kind='centrosomes'):
+        with self._h5('r') as f:
+            return read_track(f, experiment_tag, run, track_id, kind=kind)
+
+    @_operation
+    def frame_positions(self, experiment_tag, run, frame, kind='centrosomes'):
+        with self._h5('r') as f:
+            return read_frame_positions(f, experiment_tag, run, frame, kind=kind)
+
+    @_operation
+    def polygons(self, experiment_tag, run, kind='nuclei', nuclei=None, frame=None):
+        with self._h5('r') as f:
+            return read_polygons(f, experiment_tag, run, kind=kind, nuclei=nuclei, frame=frame)
+
+    @_operation
+    def add_measurements(self, csvpath, experiment_tag, run, dfc=None):
+        dfc = ImagejPandas(csvpath) if dfc is None else dfc
+        with self.session():
+            self._add_measurements(dfc, experiment_tag, run)
+        self.process_selection_for_run(experiment_tag, run)
+
+    def _add_measurements(self, dfc, experiment_tag, run):
+        with self._h5('a') as f:
             nxmeas = f['%s/%s/measurements' % (experiment_tag, run)]
 
-            dfnt = dfc.df_nuclei.set_index('Frame').sort_index()
-            for (nuc_id), filt_nuc_df in dfnt.groupby('Nuclei'):
-                nxnucl = nxmeas.create_group('nuclei/N%02d' % nuc_id)
-                nxnucl.attrs['NX_class'] = 'NXdata'
-                nxnucl.attrs['Nuclei'] = 'N%02d' % nuc_id
-                nx = filt_nuc_df['NuclX']
-                ny = filt_nuc_df['NuclY']
-                fn = filt_nuc_df.reset_index()
-                nxnucl.create_dataset('pos', data=fn[['Frame', 'NuclX', 'NuclY']], dtype=nx.dtype)
-                nxnucl.create_dataset('frame', data=fn['Frame'], dtype=nx.dtype)
-                nxnucl.create_dataset('sample_x', data=nx, dtype=nx.dtype)
-                nxnucl.create_dataset('sample_y', data=ny, dtype=ny.dtype)
+            dfn = dfc.df_nuclei
+            write_tracks(nxmeas, 'nuclei', dfn['Nuclei'], dfn['Frame'], dfn['NuclX'], dfn['NuclY'])
+            dfct = dfc.df_centrosome
+            write_tracks(nxmeas, 'centrosomes', dfct['Centrosome'], dfct['Frame'], dfct['CentX'], dfct['CentY'])
+            if 'NuclBound' in dfn:
+                # boundary strings are parsed here once, drawing reads the polygons back as arrays
+                write_polygons(f, experiment_tag, run, 'nuclei', dfn['Nuclei'], dfn['Frame'],
+                               [parse_polygon(b) for b in dfn['NuclBound']])
 
             dfct = dfc.df_centrosome.set_index('Frame').sort_index()
 
-            for (centr_id), filt_centr_df in dfct.groupby('Centrosome'):
-                nxcid = nxmeas.create_group('centrosomes/C%03d' % centr_id)
-                nxcid.attrs['NX_class'] = 'NXdata'
-                cx = filt_centr_df['CentX']
-                cy = filt_centr_df['CentY']
-                cn = filt_centr_df.reset_index()
-                nxcid.create_dataset('pos', data=cn[['Frame', 'CentX', 'CentY']], dtype=cx.dtype)
-                nxcid.create_dataset('frame', data=cn['Frame'], dtype=cx.dtype)
-                nxcid.create_dataset('sample_x', data=cx, dtype=cx.dtype)
-                nxcid.create_dataset('sample_y', data=cy, dtype=cy.dtype)
-
-            visitedCentrosomes = []
+            selection = Selection()
+            nuclei = set(track_ids(f, experiment_tag, run, kind='nuclei'))
             for _, filt_centr_df in dfct.groupby('Centrosome'):
                 nuc_id = filt_centr_df['Nuclei'].unique()[0]
-                centrosomesOfNuclei = dfct[dfct['Nuclei'] == nuc_id].groupby('Centrosome')
-                if len(centrosomesOfNuclei.groups) >= 2:
-                    for i, ((centr_id), filt_centr_df) in enumerate(centrosomesOfNuclei):
-                        if centr_id not in visitedCentrosomes:
-                            visitedCentrosomes.append(centr_id)
-                            self.associate_centrosome_with_nuclei(centr_id, nuc_id, experiment_tag, run, i % 2)
-        dfc.merged_df.to_hdf(self.filename, '%s/%s/measurements/pandas_dataframe' % (experiment_tag, run), mode='r+')
-        dfc.df_nuclei.to_hdf(self.filename, '%s/%s/measurements/nuclei_dataframe' % (experiment_tag, run), mode='r+')
-        self.process_selection_for_run(experiment_tag, run)
+                centrosomesOfNuclei = np.unique(dfct.loc[dfct['Nuclei'] == nuc_id, 'Centrosome'])
+                if len(centrosomesOfNuclei) >= 2 and nuc_id in nuclei:
+                    for i in range(2):
+                        visited = [c for c in centrosomesOfNuclei[i::2] if c not in selection]
+                        selection = selection.associate(visited, nuc_id, i)
+            write_selection(f, experiment_tag, run, selection)
+        # tables, so that reprocessing a few nuclei reads only their rows
+        self._to_hdf(dfc.merged_df, '%s/%s/measurements/pandas_dataframe' % (experiment_tag, run), table=True)
+        self._to_hdf(dfc.df_nuclei, '%s/%s/measurements/nuclei_dataframe' % (experiment_tag, run), table=True)
+
+    def _processed_runs(self, table, conditions=None, runs=None):
+        with self._h5('r') as f:
+            return [(experiment_tag, run) for experiment_tag in f for run in f['%s' % experiment_tag]
+                    if table in f['%s/%s/processed' % (experiment_tag, run)] and
+                    (conditions is None or experiment_tag in conditions) and (runs is None or run in runs)]
+
+    def _read_processed(self, table, conditions=None, runs=None, nuclei=None, workers=1):
+        conditions, runs, nuclei = _as_list(conditions), _as_list(runs), _as_list(nuclei)
+        parts = [(self.filename, '%s/%s/processed/%s' % (experiment_tag, run, table), experiment_tag, run, nuclei)
+                 for experiment_tag, run in self._processed_runs(table, conditions=conditions, runs=runs)]
+        # reading in other processes needs the file closed here, or it stays locked by this process
+        if workers > 1 and self._session is None:
+            dfs = list(_bounded_map(_read_partition, parts, workers))
+        else:
+            with self.session('r'):
+                dfs = [_label_partition(self._read_hdf(key, nuclei=nuclei), experiment_tag, run)
+                       for _, key, experiment_tag, run, nuclei in parts]
+        if len(dfs) == 0:
+            return pd.DataFrame()
+        return pd.concat(dfs, sort=True)
 
     @property
+    @_operation
     def dataframe(self):
-        df_out = pd.DataFrame()
-        with h5py.File(self.filename, 'r') as f:
-            for experiment_tag in f:
-                for run in f['%s' % experiment_tag]:
-                    if 'pandas_dataframe' in f['%s/%s/processed' % (experiment_tag, run)]:
-                        selection_key = '%s/%s/processed/pandas_dataframe' % (experiment_tag, run)
-                        df = pd.read_hdf(self.filename, key=selection_key, mode='r')
-                        df['condition'] = experiment_tag
-                        df['run'] = run
-                        df_out = df_out.append(df, sort=True)
+        return self.read_dataframe()
+
+    @property
+    @_operation
+    def mask(self):
+        return self.read_mask()
+
+    @_operation
+    def read_dataframe(self, conditions=None, runs=None, nuclei=None, workers=1):
+        """
+            Processed centrosome data of every run, or only of the given conditions, runs and nuclei. Each filter
+            can be a single value or a list. Runs are read in a pool of processes if workers > 1.
+        """
+        df_out = self._read_processed('pandas_dataframe', conditions=conditions, runs=runs, nuclei=nuclei,
+                                      workers=workers)
+        if df_out.empty: return df_out
         df_out = stats.reconstruct_time(df_out)
         df_out.loc[:, ['Frame', 'Centrosome', 'Nuclei']] = df_out[['Frame', 'Centrosome', 'Nuclei']].astype('int32')
         df_out.loc[:, 'Time'] = df_out['Time'].astype('float64')
 
-        return df_out
+        return _categorize(df_out)
 
-    @property
-    def mask(self):
-        df_msk = pd.DataFrame()
-        with h5py.File(self.filename, 'r') as f:
+    @_operation
+    def read_mask(self, conditions=None, runs=None, nuclei=None, workers=1):
+        """ Masks of the interpolated data, filtered as in read_dataframe. """
+        df_msk = self._read_processed('pandas_masks', conditions=conditions, runs=runs, nuclei=nuclei,
+                                      workers=workers)
+        return _categorize(stats.reconstruct_time(df_msk))
+
+    @_operation
+    def process_selection_for_run(self, experiment_tag, run, nuclei=None):
+        """
+            Builds the processed tables of a run from its selection. If nuclei is given and the run was already
+            processed, only those nuclei are recomputed and spliced into the stored tables.
+        """
+        with self.session('r'):
+            job = self._selection_job(experiment_tag, run, nuclei=nuclei)
+        result = _process_selection_job(job)
+        with self.session():
+            self._store_processed(*result)
+
+    @_operation
+    def stale_runs(self):
+        """ Runs whose selection changed since their processed tables were last built. """
+        with self._h5('r') as f:
+            stale = list()
             for experiment_tag in f:
-                for run in f['%s' % experiment_tag]:
-                    if 'pandas_masks' in f['%s/%s/processed' % (experiment_tag, run)]:
-                        selection_key = '%s/%s/processed/pandas_masks' % (experiment_tag, run)
-                        msk = pd.read_hdf(self.filename, key=selection_key, mode='r')
-                        msk.loc[':,condition'] = experiment_tag
-                        msk.loc[:, 'run'] = run
-                        df_msk = df_msk.append(msk, sort=True)
-        return stats.reconstruct_time(df_msk)
-
-    def process_selection_for_run(self, experiment_tag, run):
-        with h5py.File(self.filename, 'r') as f:
-            nuclei_list = list(f['%s/%s/selection' % (experiment_tag, run)].keys())
+                for run in f[experiment_tag]:
+                    fsel = f['%s/%s/selection' % (experiment_tag, run)]
+                    fproc = f['%s/%s/processed' % (experiment_tag, run)]
+                    revision = fsel.attrs.get('revision', 0)
+                    if fproc.attrs.get('selection_revision', -1) != revision or \
+                            ('pandas_dataframe' not in fproc and len(read_selection(f, experiment_tag, run)) > 0):
+                        stale.append((experiment_tag, run))
+        return stale
+
+    @_operation
+    def reprocess_selections(self, workers=1, force=False, progress=None):
+        """
+            Rebuilds the processed tables of every stale run, or of all of them if force is set. Runs are processed
+            in a pool of worker processes while this process reads their inputs and writes the results.
+            progress is called with (done, total) as runs are stored; an exception raised from it stops the
+            reprocessing, leaving the remaining runs stale.
+            Returns a list of (condition, run, seconds) with the processing time of each run.
+        """
+        if force:
+            with self._h5('r') as f:
+                runs = [(experiment_tag, run) for experiment_tag in f for run in f[experiment_tag]]
+        else:
+            runs = self.stale_runs()
+        logging.info('%d runs to reprocess' % len(runs))
+
+        def jobs():
+            for experiment_tag, run in runs:
+                try:
+                    with self.session('r'):
+                        job = self._selection_job(experiment_tag, run)
+                except KeyError as e:
+                    logging.warning('skipping %s-%s due to lack of data. %s' % (experiment_tag, run, e))
+                    continue
+                yield job
+
+        # the file is only locked while a run is read or stored, not while waiting for the workers
+        timings = list()
+        for i, result in enumerate(_bounded_map(_process_selection_job, jobs(), workers)):
+            job, elapsed = result[0], result[-1]
+            with self.session():
+                self._store_processed(*result)
+            timings.append((job['experiment_tag'], job['run'], elapsed))
+            logging.info('[%d/%d] %s-%s processed in %0.2f s' %
+                         (i + 1, len(runs), job['experiment_tag'], job['run'], elapsed))
+            if progress is not None: progress(i + 1, len(runs))
+        # runs skipped for lack of data are done too
+        if progress is not None and len(timings) < len(runs): progress(len(runs), len(runs))
+        return timings
+
+    def _selection_job(self, experiment_tag, run, nuclei=None):
+        # reads everything needed to process the selection of a run, so that the processing itself doesn't need the file
+        with self._h5('r') as f:
+            sel = read_selection(f, experiment_tag, run)
             logging.debug(
-                'for %s %s there are %d nuclei: %s' % (experiment_tag, run, len(nuclei_list), str(nuclei_list)))
-            # don't keep processing if there's nothing to do
-            if len(nuclei_list) == 0: return
+                'for %s %s there are %d nuclei: %s' % (experiment_tag, run, len(sel.nuclei), str(sel.nuclei)))
+            fproc = f['%s/%s/processed' % (experiment_tag, run)]
+            incremental = nuclei is not None and 'pandas_dataframe' in fproc and 'pandas_masks' in fproc
+            revision = f['%s/%s/selection' % (experiment_tag, run)].attrs.get('revision', 0)
+            # nothing to process, but the old tables still have to go and the revision be recorded
+            if len(sel) == 0 and not incremental:
+                return {'experiment_tag': experiment_tag, 'run': run, 'tracks': pd.DataFrame(), 'revision': revision,
+                        'nuclei': None}
 
+            has_boundary = 'boundary' in fproc
+
+        centrosomes = None
+        if incremental:
+            # only the rows of the nuclei being updated, and of the centrosomes now selected for them, are read
+            nuclei = np.atleast_1d(nuclei)
+            centrosomes = [c for n in nuclei for c in sel.centrosomes(n)]
+            if len(centrosomes) == 0:
+                return {'experiment_tag': experiment_tag, 'run': run, 'tracks': pd.DataFrame(), 'revision': revision,
+                        'nuclei': nuclei}
         merge_key = '%s/%s/measurements/pandas_dataframe' % (experiment_tag, run)
         nuclei_key = '%s/%s/measurements/nuclei_dataframe' % (experiment_tag, run)
-        pdhdf_measured = pd.read_hdf(self.filename, key=merge_key, mode='r')
-        pdhdf_nuclei = pd.read_hdf(self.filename, key=nuclei_key, mode='r')
-
-        # update centrosome nuclei from selection
-        centrosomes_of_nuclei_a = centrosomes_of_nuclei_b = None
-        centrosomes_all = list()
-        with h5py.File(self.filename, 'r') as f:
-            for nuclei_str in nuclei_list:
-                if nuclei_str == 'pandas_dataframe' or nuclei_str == 'pandas_masks': continue
-                nuclei_id = int(nuclei_str[1:])
-                sel_str = '%s/%s/selection/%s' % (experiment_tag, run, nuclei_str)
-                centrosomes_of_nuclei_a = [int(c[1:]) for c in f['%s/A' % (sel_str)].keys()]
-                centrosomes_of_nuclei_b = [int(c[1:]) for c in f['%s/B' % (sel_str)].keys()]
-                for centr_id in centrosomes_of_nuclei_a + centrosomes_of_nuclei_b:
-                    pdhdf_measured.loc[pdhdf_measured['Centrosome'] == centr_id, 'Nuclei'] = nuclei_id
-                # tag centrosomes with the label given in the GUI
-                for centr_id in centrosomes_of_nuclei_a:
-                    pdhdf_measured.loc[pdhdf_measured['Centrosome'] == centr_id, 'CentrLabel'] = 'A'
-                for centr_id in centrosomes_of_nuclei_b:
-                    pdhdf_measured.loc[pdhdf_measured['Centrosome'] == centr_id, 'CentrLabel'] = 'B'
-
-                centrosomes_all.extend(centrosomes_of_nuclei_a + centrosomes_of_nuclei_b)
-
-        # re-merge with nuclei data
+        pdhdf_measured = self._read_hdf(merge_key, centrosomes=centrosomes)
+        pdhdf_nuclei = self._read_hdf(nuclei_key, nuclei=nuclei if incremental else None)
+
+        # update centrosome nuclei from selection and re-merge with nuclei data
+        pdhdf_measured = relabel_selection(pdhdf_measured, sel)
         pdhdf_measured.drop(['NuclX', 'NuclY', 'NuclBound'], axis=1, inplace=True)
-        pdhdf_measured = pdhdf_measured[pdhdf_measured['Centrosome'].isin(centrosomes_all)]
         df_merge = pdhdf_measured.merge(pdhdf_nuclei, how='left')
 
         # merge with cell boundary data
-        with h5py.File(self.filename, 'r') as f:
-            if 'boundary' in f['%s/%s/processed' % (experiment_tag, run)]:
-                df_cell = pd.read_hdf(self.filename, key='%s/%s/processed/boundary' % (experiment_tag, run))
-                df_cell = df_cell.loc[~df_cell['CellBound'].isnull(),
-                                      set(ImagejPandas.MASK_INDEX + ['CellX', 'CellY', 'CellBound',
-                                                                     'DistCell', 'SpdCell', 'AccCell'])]
-
-                if 'CellBound' in df_merge.columns and not df_cell.empty:
-                    logging.info('clearing CellBound')
-                    df_merge.drop(['CellX', 'CellY', 'CellBound'], axis=1, inplace=True)
-                df_merge = df_merge.merge(df_cell, how='left')
+        if has_boundary:
+            df_cell = self._read_hdf('%s/%s/processed/boundary' % (experiment_tag, run),
+                                     nuclei=nuclei if incremental else None)
+            df_cell = df_cell.loc[~df_cell['CellBound'].isnull(),
+                                  set(ImagejPandas.MASK_INDEX + ['CellX', 'CellY', 'CellBound',
+                                                                 'DistCell', 'SpdCell', 'AccCell'])]
+
+            if 'CellBound' in df_merge.columns and not df_cell.empty:
+                logging.info('clearing CellBound')
+                df_merge.drop(['CellX', 'CellY', 'CellBound'], axis=1, inplace=True)
+            df_merge = df_merge.merge(df_cell, how='left')
 
         df_merge['condition'] = experiment_tag
         df_merge['run'] = run
+        if incremental:
+            df_merge = df_merge[df_merge['Nuclei'].isin(nuclei)]
+        df_merge = df_merge.dropna(how='all')
+        df_merge = df_merge[~df_merge['CentrLabel'].isnull()]
         logging.debug('nuclei to process: ' + str(df_merge.groupby(ImagejPandas.NUCLEI_INDIV_INDEX).size()))
 
-        try:
-            with h5py.File(self.filename, 'r+') as f:
+        return {'experiment_tag': experiment_tag, 'run': run, 'tracks': df_merge, 'revision': revision,
+                'nuclei': nuclei if incremental else None}
+
+    def _store_processed(self, job, proc_df, mask_df, error, elapsed):
+        experiment_tag, run, nuclei = job['experiment_tag'], job['run'], job['nuclei']
+        proc_key = '%s/%s/processed/pandas_dataframe' % (experiment_tag, run)
+        mask_key = '%s/%s/processed/pandas_masks' % (experiment_tag, run)
+        if nuclei is None:
+            with self._h5('r+') as f:
                 fproc = f['%s/%s/processed' % (experiment_tag, run)]
                 if 'pandas_dataframe' in fproc: del fproc['pandas_dataframe']
                 if 'pandas_masks' in fproc: del fproc['pandas_masks']
+        if error is not None:
+            logging.warning('Problem processing %s-%s %s' % (experiment_tag, run, error))
+            return
+
+        if nuclei is not None:
+            # an incremental update leaves the run stale, as the other nuclei may have changed since too
+            with self._pd('a') as store:
+                _replace_nuclei(store, proc_key, proc_df, nuclei)
+                _replace_nuclei(store, mask_key, mask_df, nuclei)
+            return
+        if not proc_df.empty:
+            self._to_hdf(proc_df, proc_key, table=True)
+            self._to_hdf(mask_df, mask_key, table=True)
+        with self._h5('r+') as f:
+            f['%s/%s/processed' % (experiment_tag, run)].attrs['selection_revision'] = job['revision']
+
+    @_operation
+    def read_processed(self, experiment_tag, run, table, nuclei=None, frame=None):
+        """ Rows of a processed table (pandas_dataframe, pandas_masks or boundary), optionally of some nuclei or a frame. """
+        return self._read_hdf('%s/%s/processed/%s' % (experiment_tag, run, table), nuclei=nuclei, frame=frame)
+
+    @_operation
+    def write_processed(self, experiment_tag, run, table, df, nuclei=None):
+        """ Stores a processed table; if nuclei is given, only the rows of those nuclei are replaced by df. """
+        key = '%s/%s/processed/%s' % (experiment_tag, run, table)
+        if nuclei is None:
+            self._to_hdf(df, key, table=True)
+        else:
+            with self._pd('a') as store:
+                _replace_nuclei(store, key, df, _as_list(nuclei))
+
+    @_operation
+    def selection(self, experiment_tag, run):
+        with self._h5('r') as f:
+            return read_selection(f, experiment_tag, run)
+
+    @property
+    @_operation
+    def selections(self):
+        """ Selection of every run in the file as one dataframe. """
+        with self._h5('r') as f:
+            dfs = list()
+            for experiment_tag in f:
+                for run in f[experiment_tag]:
+                    df = read_selection(f, experiment_tag, run).to_dataframe()
+                    df['condition'], df['run'] = experiment_tag, run
+                    dfs.append(df)
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=['Centrosome', 'Nuclei', 'CentrLabel', 'condition', 'run'])
+        return pd.concat(dfs, ignore_index=True)
 
-            df_merge.dropna(how='all', inplace=True)
-            df_merge = df_merge[~df_merge['CentrLabel'].isnull()]
-            df_interpolated, imask = ImagejPandas.interpolate_data(df_merge)
-            df_interpolated = ImagejPandas.vel_acc_nuclei(df_interpolated)
-            proc_df = ImagejPandas.dist_vel_acc_centrosomes(df_interpolated)
-
-            maxframe1 = proc_df.loc[proc_df['CentrLabel'] == 'A', 'Frame'].max()
-            maxframedc = proc_df['Frame'].max()
-            minframe1 = min(maxframe1, maxframedc)
-
-            idx1 = (proc_df['CentrLabel'] == 'A') & (proc_df['Frame'] <= minframe1)
-            proc_df.loc[idx1, 'SpeedCentr'] *= -1
-            proc_df.loc[idx1, 'AccCentr'] *= -1
-
-            # process interpolated data mask
-            mask_df = imask[imask['Nuclei'] > 0]
-            mi = mask_df.set_index(ImagejPandas.MASK_INDEX).sort_index()
-            mu = mi.unstack('CentrLabel')
-            msk = mu.loc[:, ['CentX', 'CentY']].all(axis=1)
-            for key in ['Dist', 'Speed', 'Acc']:
-                mu.loc[:, (key, 'A')] = mu.loc[:, ('CentX', 'A')]
-                mu.loc[:, (key, 'B')] = mu.loc[:, ('CentX', 'B')]
-            for key in ['DistCentr', 'SpeedCentr', 'AccCentr']:
-                mu.loc[:, (key, 'A')] = msk
-            mask_df = mu.stack().reset_index()
-
-            proc_df.to_hdf(self.filename, key='%s/%s/processed/pandas_dataframe' % (experiment_tag, run), mode='r+')
-            mask_df.to_hdf(self.filename, key='%s/%s/processed/pandas_masks' % (experiment_tag, run), mode='r+')
-        except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            logging.warning('Problem processing %s-%s in line %d of hdf5_nexus.py:\r\n%s' % (
-                experiment_tag, run, exc_tb.tb_lineno, e))
+    @staticmethod
+    def _process_tracks(df_merge):
+        df_interpolated, imask = ImagejPandas.interpolate_data(df_merge)
+        df_interpolated = ImagejPandas.vel_acc_nuclei(df_interpolated)
+        proc_df = ImagejPandas.dist_vel_acc_centrosomes(df_interpolated)
 
+        maxframe1 = proc_df.loc[proc_df['CentrLabel'] == 'A', 'Frame'].max()
+        maxframedc = proc_df['Frame'].max()
+        minframe1 = min(maxframe1, maxframedc)
+
+        idx1 = (proc_df['CentrLabel'] == 'A') & (proc_df['Frame'] <= minframe1)
+        proc_df.loc[idx1, 'SpeedCentr'] *= -1
+        proc_df.loc[idx1, 'AccCentr'] *= -1
+
+        # process interpolated data mask
+        mask_df = imask[imask['Nuclei'] > 0]
+        mi = mask_df.set_index(ImagejPandas.MASK_INDEX).sort_index()
+        mu = mi.unstack('CentrLabel')
+        msk = mu.loc[:, ['CentX', 'CentY']].all(axis=1)
+        for key in ['Dist', 'Speed', 'Acc']:
+            mu.loc[:, (key, 'A')] = mu.loc[:, ('CentX', 'A')]
+            mu.loc[:, (key, 'B')] = mu.loc[:, ('CentX', 'B')]
+        for key in ['DistCentr', 'SpeedCentr', 'AccCentr']:
+            mu.loc[:, (key, 'A')] = msk
+        mask_df = mu.stack().reset_index()
+
+        return proc_df, mask_df
+
+    @_operation
     def associate_centrosome_with_nuclei(self, centr_id, nuc_id, experiment_tag, run, centrosome_group=0):
-        with h5py.File(self.filename, 'a') as f:
-            # link centrosome to current nuclei selection
-            source_cpos_addr = '%s/%s/measurements/centrosomes/C%03d/pos' % (experiment_tag, run, centr_id)
-            source_npos_addr = '%s/%s/measurements/nuclei/N%02d/pos' % (experiment_tag, run, nuc_id)
-            nxcpos = f[source_cpos_addr]
-
-            target_addr = '%s/%s/selection/N%02d' % (experiment_tag, run, nuc_id)
-            if source_npos_addr in f:
-                if target_addr not in f:
-                    nxnuc_ = f.create_group(target_addr)
-                    nxnuc_.create_group('A')
-                    nxnuc_.create_group('B')
-                    nxnpos = f[source_npos_addr]
-                    nxnuc_['pos'] = nxnpos
-
-                cstr = 'A' if centrosome_group == 0 else 'B'
-                nxnuc_ = f['%s/%s' % (target_addr, cstr)]
-                nxnuc_['C%03d' % centr_id] = nxcpos
+        """ centr_id can be a single centrosome or a list of them, which are all tagged with the same nucleus. """
+        with self._h5('a') as f:
+            centr_id = Selection._ids(centr_id)
+            missing = centr_id[~np.isin(centr_id, track_ids(f, experiment_tag, run, kind='centrosomes'))]
+            if len(missing) > 0:
+                raise KeyError('no track for centrosomes %s in %s-%s' % (missing.tolist(), experiment_tag, run))
 
+            # tag centrosome with current nuclei selection
+            if nuc_id in track_ids(f, experiment_tag, run, kind='nuclei'):
+                sel = read_selection(f, experiment_tag, run)
+                write_selection(f, experiment_tag, run, sel.associate(centr_id, nuc_id, centrosome_group))
+
+    @_operation
     def clear_associations(self, experiment_tag, run):
-        with h5py.File(self.filename, 'a') as f:
+        with self._h5('a') as f:
             fsel = f['%s/%s/selection' % (experiment_tag, run)]
             for o in fsel:
                 del fsel[o]
+            for a in [a for a in fsel.attrs if a.endswith('_gabor_threshold')]:
+                del fsel.attrs[a]
+            write_selection(f, experiment_tag, run, Selection())
 
+    @_operation
     def delete_association(self, of_centrosome, with_nuclei, experiment_tag, run):
-        with h5py.File(self.filename, 'a') as f:
-            centosomesA = f['%s/%s/selection/N%02d/A' % (experiment_tag, run, with_nuclei)]
-            centosomesB = f['%s/%s/selection/N%02d/B' % (experiment_tag, run, with_nuclei)]
-            if 'C%03d' % of_centrosome in centosomesA:
-                del centosomesA['C%03d' % of_centrosome]
-            if 'C%03d' % of_centrosome in centosomesB:
-                del centosomesB['C%03d' % of_centrosome]
-
-            with h5py.File(self.filename, 'a') as f:
+        """ of_centrosome can be a list of centrosomes, or None to unselect every centrosome of the nucleus. """
+        with self.session():
+            with self._h5('a') as f:
+                sel = read_selection(f, experiment_tag, run)
+                if of_centrosome is None:
+                    of_centrosome = sel.centrosomes(with_nuclei)
+                write_selection(f, experiment_tag, run, sel.delete(centrosomes=of_centrosome, nuclei=with_nuclei))
+
                 fproc = f['%s/%s/processed' % (experiment_tag, run)]
-                df_key = '%s/%s/processed/pandas_dataframe' % (experiment_tag, run)
-                msk_key = '%s/%s/processed/pandas_masks' % (experiment_tag, run)
-                _newdf = _newmsk = None
-                if 'pandas_dataframe' in fproc:
-                    _newdf = pd.read_hdf(self.filename, key=df_key, mode='r')
-                    del fproc['pandas_dataframe']
-                if _newdf is not None:
-                    _idx = (_newdf['Centrosome'] == of_centrosome) & \
-                           (_newdf['Nuclei'] == with_nuclei)
-                    _newdf[~_idx].to_hdf(self.filename, key=df_key, mode='r+')
-                if 'pandas_masks' in fproc:
-                    _newmsk = pd.read_hdf(self.filename, key=msk_key, mode='r')
-                    del fproc['pandas_masks']
-                if _newmsk is not None:
-                    _idx = (_newmsk['Centrosome'] == of_centrosome) & \
-                           (_newmsk['Nuclei'] == with_nuclei)
-                    _newmsk[~_idx].to_hdf(self.filename, key=msk_key, mode='r+')
+                tables = [t for t in ['pandas_dataframe', 'pandas_masks'] if t in fproc]
+
+            with self._pd('a') as store:
+                for table in tables:
+                    key = '%s/%s/processed/%s' % (experiment_tag, run, table)
+                    _remove_rows(store, key, nuclei=[with_nuclei], centrosomes=Selection._ids(of_centrosome))
 
+    @_operation
     def move_association(self, of_centrosome, from_nuclei, toNuclei, centrosome_group, experiment_tag, run):
-        self.delete_association(of_centrosome, from_nuclei, experiment_tag, run)
-        self.associate_centrosome_with_nuclei(of_centrosome, toNuclei, experiment_tag, run)
+        with self.session():
+            self.delete_association(of_centrosome, from_nuclei, experiment_tag, run)
+            self.associate_centrosome_with_nuclei(of_centrosome, toNuclei, experiment_tag, run, centrosome_group)
 
+    @_operation
     def is_centrosome_associated(self, centrosome, experiment_tag, run):
-        with h5py.File(self.filename, 'r') as f:
-            nuclei_list = f['%s/%s/measurements/nuclei' % (experiment_tag, run)]
-            sel = f['%s/%s/selection' % (experiment_tag, run)]
-            for nuclei in nuclei_list:
-                if nuclei in sel:
-                    nuc = sel[nuclei]
-                    if centrosome in nuc['A'] or centrosome in nuc['B']:
-                        return True
-        return False
+        return centrosome in self.selection(experiment_tag, run)
 
 
 def move_images(filefrom, fileto):
@@ -391,15 +1204,12 @@ def move_images(filefrom, fileto):
     dst.close()
 
 
-def process_dir(path, hdf5f):
-    condition = os.path.abspath(args.input).split('/')[-1]
-
+def _runs_of_dir(path):
     for root, directories, filenames in os.walk(os.path.join(path, 'input')):
         for filename in filenames:
             ext = filename.split('.')[-1]
             if ext == 'tif':
                 joinf = os.path.join(root, filename)
-                logging.info('--------------------------------------------------------------')
                 groups = re.search('^(.+)-(.+).tif$', filename).groups()
                 run_id = groups[1]
                 run_str = 'run_%s' % run_id
@@ -407,12 +1217,225 @@ def process_dir(path, hdf5f):
                 nucldata = os.path.join(path, 'data', 'run-%s-nuclei.csv' % run_id)
 
                 if os.path.isfile(centdata) and os.path.isfile(nucldata) and os.path.isfile(joinf):
-                    logging.info('adding raw file: %s' % joinf)
-                    hdf5.add_experiment(condition, run_str)
-                    logging.info('adding tiff:', joinf)
-                    hdf5f.add_tiff_sequence(joinf, condition, run_str)
-                    logging.info('adding data file: %s' % centdata)
-                    hdf5f.add_measurements(centdata, condition, run_str)
+                    yield joinf, run_str, centdata, nucldata
+
+
+def _file_hash(path, blocksize=2 ** 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def source_manifest(tiff, table, nuclei, previous=None):
+    """
+        Describes the source files of a run by size, modification time and content hash.
+        Hashes are reused from a previous manifest when size and modification time didn't change.
+    """
+    manifest = dict()
+    for key, path in [('tiff', tiff), ('table', table), ('nuclei', nuclei)]:
+        st = os.stat(path)
+        entry = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+        old = previous.get(key) if previous is not None else None
+        if old is not None and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+            entry['sha1'] = old['sha1']
+        else:
+            entry['sha1'] = _file_hash(path)
+        manifest[key] = entry
+    return manifest
+
+
+def _changed_sources(manifest, previous):
+    if previous is None:
+        return set(manifest.keys())
+    return set([k for k in manifest if k not in previous or manifest[k]['sha1'] != previous[k]['sha1']])
+
+
+def _parse_run(run):
+    # runs in a worker process: parse the csv tables, but never touch the HDF5 file. Tiffs are left to the writer,
+    # which streams them frame by frame; sending decoded movies back would hold several of them in memory
+    centdata = run[2]
+    return run, None, ImagejPandas(centdata)
+
+
+def _as_list(x):
+    return None if x is None else list(x) if isinstance(x, (list, tuple, set, np.ndarray)) else [x]
+
+
+def _label_partition(df, experiment_tag, run):
+    return df.assign(condition=experiment_tag, run=run)
+
+
+def _read_partition(part):
+    # runs in a worker process, reading one processed table of the file
+    filename, key, experiment_tag, run, nuclei = part
+    with pd.HDFStore(filename, mode='r') as store:
+        return _label_partition(_select(store, key, nuclei=nuclei), experiment_tag, run)
+
+
+# processed tables are stored in PyTables' table format, indexed on these columns so rows can be selected and
+# deleted with where clauses
+PROCESSED_DATA_COLUMNS = ['Nuclei', 'Frame', 'CentrLabel', 'Centrosome']
+
+
+def _where(nuclei=None, frame=None, centrosomes=None):
+    terms = list()
+    if nuclei is not None:
+        terms.append('Nuclei in %s' % [int(n) for n in nuclei])
+    if frame is not None:
+        terms.append('Frame == %d' % frame)
+    if centrosomes is not None:
+        terms.append('Centrosome in %s' % [int(c) for c in centrosomes])
+    return ' & '.join(['(%s)' % t for t in terms]) if terms else None
+
+
+def _rows(df, nuclei=None, frame=None, centrosomes=None):
+    # same as _where, for tables in the fixed format of older files
+    ix = np.ones(len(df), dtype=bool)
+    if nuclei is not None:
+        ix &= df['Nuclei'].isin(nuclei).values
+    if frame is not None:
+        ix &= (df['Frame'] == frame).values
+    if centrosomes is not None:
+        ix &= df['Centrosome'].isin(centrosomes).values
+    return ix
+
+
+def _encode_table(df):
+    # the table format can't store object columns mixing booleans and NaN, as in the masks; store them as floats
+    bool_columns = [c for c in df.columns if df[c].dtype == object and df[c].notnull().any() and
+                    pd.api.types.infer_dtype(df[c].dropna()) == 'boolean']
+    return df.astype({c: np.float64 for c in bool_columns}), bool_columns
+
+
+def _put_table(store, key, df):
+    df, bool_columns = _encode_table(df)
+    store.put(key, df, format='table', data_columns=[c for c in PROCESSED_DATA_COLUMNS if c in df])
+    store.get_storer(key).attrs.bool_columns = bool_columns
+
+
+def _select(store, key, nuclei=None, frame=None, centrosomes=None):
+    nuclei, centrosomes = _as_list(nuclei), _as_list(centrosomes)
+    storer = store.get_storer(key)
+    if not storer.is_table:
+        df = store.get(key)
+        return df[_rows(df, nuclei=nuclei, frame=frame, centrosomes=centrosomes)]
+    df = store.select(key, where=_where(nuclei=nuclei, frame=frame, centrosomes=centrosomes))
+    for c in getattr(storer.attrs, 'bool_columns', []):
+        df[c] = df[c].map({1.0: True, 0.0: False})
+    return df
+
+
+def _remove_rows(store, key, nuclei=None, centrosomes=None):
+    if store.get_storer(key).is_table:
+        store.remove(key, where=_where(nuclei=nuclei, centrosomes=centrosomes))
+    else:
+        df = store.get(key)
+        _put_table(store, key, df[~_rows(df, nuclei=nuclei, centrosomes=centrosomes)])
+
+
+def _replace_nuclei(store, key, df, nuclei):
+    # swaps the rows of the given nuclei in a stored table for those in df
+    if key not in store:
+        _put_table(store, key, df)
+        return
+    _remove_rows(store, key, nuclei=nuclei)
+    if df.empty:
+        return
+    try:
+        store.append(key, _encode_table(df)[0], format='table',
+                     data_columns=[c for c in PROCESSED_DATA_COLUMNS if c in df])
+    except (ValueError, TypeError):
+        # longer strings than the table was sized for, or different columns; rewrite it whole
+        _put_table(store, key, pd.concat([_select(store, key), df], sort=False))
+
+
+def _categorize(df):
+    # these columns take few distinct values, so categories save most of their memory
+    for col in ['condition', 'run', 'CentrLabel']:
+        if col in df:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def _process_selection_job(job):
+    # runs in a worker process when reprocessing in parallel, so it never touches the HDF5 file
+    t0 = time.time()
+    try:
+        if job['tracks'].empty:
+            # nothing is selected (or the nuclei were unselected), so only the old rows have to go
+            proc_df, mask_df = pd.DataFrame(), pd.DataFrame()
+        else:
+            proc_df, mask_df = LabHDF5NeXusFile._process_tracks(job['tracks'])
+        return job, proc_df, mask_df, None, time.time() - t0
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        while exc_tb.tb_next is not None:
+            exc_tb = exc_tb.tb_next
+        error = 'in line %d of %s:\r\n%s' % (exc_tb.tb_lineno, os.path.basename(exc_tb.tb_frame.f_code.co_filename), e)
+        return job, None, None, error, time.time() - t0
+
+
+def _bounded_map(fn, items, workers):
+    # keep a bounded window of items in flight so results don't pile up waiting for the writer
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    # workers are spawned rather than forked so they don't inherit the writer's open handles, which would keep the
+    # HDF5 file locked
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def process_dir(path, hdf5f, layout='frames', compression='gzip', workers=1, force=False, preview=True):
+    """
+        Ingests every run of the input folder. With workers > 1, csv files are parsed in a pool of processes while
+        this process remains the only writer of the HDF5 file, streaming each tiff into it frame by frame and
+        writing runs in the same order as a serial ingestion would.
+        Runs whose source files match the manifest stored in the file are skipped unless force is set; runs
+        without manifest (new, or interrupted in a previous ingestion) are rebuilt.
+        With preview set, the uint8 preview images the viewers animate are built along with the raw data.
+    """
+    condition = os.path.abspath(path).split('/')[-1]
+
+    pending = list()
+    for joinf, run_str, centdata, nucldata in _runs_of_dir(path):
+        previous = hdf5f.run_manifest(condition, run_str)
+        manifest = source_manifest(joinf, centdata, nucldata, previous=previous)
+        changed = _changed_sources(manifest, previous)
+        if not changed and not force:
+            logging.info('skipping %s, source files unchanged.' % run_str)
+            # files were touched but not modified, keep their new modification times to avoid hashing them again
+            if manifest != previous: hdf5f.set_run_manifest(condition, run_str, manifest)
+            continue
+        logging.info('%s needs ingestion, changed: %s' % (run_str, ', '.join(sorted(changed)) or 'none'))
+        pending.append((joinf, run_str, centdata, manifest, force or 'tiff' in changed))
+
+    if workers > 1:
+        runs = _bounded_map(_parse_run, pending, workers)
+    else:
+        runs = ((run, None, None) for run in pending)
+
+    for (joinf, run_str, centdata, manifest, clear_raw), decoded, dfc in runs:
+        logging.info('--------------------------------------------------------------')
+        logging.info('adding raw file: %s' % joinf)
+        hdf5f.add_experiment(condition, run_str, clear_raw=clear_raw)
+        logging.info('adding tiff: %s' % joinf)
+        hdf5f.add_tiff_sequence(joinf, condition, run_str, layout=layout, compression=compression, decoded=decoded)
+        if preview:
+            logging.info('building preview images.')
+            hdf5f.add_preview(condition, run_str)
+        logging.info('adding data file: %s' % centdata)
+        hdf5f.add_measurements(centdata, condition, run_str, dfc=dfc)
+        hdf5f.set_run_manifest(condition, run_str, manifest)
 
 
 if __name__ == '__main__':
@@ -420,22 +1443,35 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Creates an HDF5 file for experiments storage.')
     parser.add_argument('input', metavar='I', type=str, help='input directory where the files are')
+    parser.add_argument('--layout', choices=['frames', 'stack'], default='frames',
+                        help='store raw images as one group per frame or as a single chunked (T,C,Y,X) dataset')
+    parser.add_argument('--compression', choices=['gzip', 'lzf', 'none'], default='gzip',
+                        help='compression filter for the stack layout')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing tables in parallel')
+    parser.add_argument('--force', action='store_true', help='rebuild every run even if its sources are unchanged')
+    parser.add_argument('--no-preview', action='store_true',
+                        help='skip the 8-bit preview images, the viewers will build them when a run is first opened')
+    parser.add_argument('--no-repack', action='store_true', help='skip the final h5repack of both files')
     args = parser.parse_args()
+    compression = None if args.compression == 'none' else args.compression
 
     # Create hdf5 file if it doesn't exist
     hdf5 = LabHDF5NeXusFile(filename='out/centrosomes.nexus.hdf5',
                             imagesfile='out/centrosomes-images.nexus.hdf5', fileflag='a')
     try:
-        process_dir(args.input, hdf5)
+        process_dir(args.input, hdf5, layout=args.layout, compression=compression, workers=args.workers,
+                    force=args.force, preview=not args.no_preview)
         move_images('out/centrosomes.nexus.hdf5', 'out/centrosomes-images.nexus.hdf5')
 
-        logging.info('--------------------------------------------------------------')
-        logging.info('shrinking file size...')
-        call('h5repack out/centrosomes.nexus.hdf5 out/repack.hdf5', shell=True)
-        os.remove('out/centrosomes.nexus.hdf5')
-        os.rename('out/repack.hdf5', 'out/centrosomes.nexus.hdf5')
-        call('h5repack out/centrosomes-images.nexus.hdf5 out/repack.hdf5', shell=True)
-        os.remove('out/centrosomes-images.nexus.hdf5')
-        os.rename('out/repack.hdf5', 'out/centrosomes-images.nexus.hdf5')
+        if not args.no_repack:
+            logging.info('--------------------------------------------------------------')
+            logging.info('shrinking file size...')
+            call('h5repack out/centrosomes.nexus.hdf5 out/repack.hdf5', shell=True)
+            os.remove('out/centrosomes.nexus.hdf5')
+            os.rename('out/repack.hdf5', 'out/centrosomes.nexus.hdf5')
+            call('h5repack out/centrosomes-images.nexus.hdf5 out/repack.hdf5', shell=True)
+            os.remove('out/centrosomes-images.nexus.hdf5')
+            os.rename('out/repack.hdf5', 'out/centrosomes-images.nexus.hdf5')
     finally:
         logging.info('finished.')
@@ -7,6 +7,18 @@ import pandas as pd
 
 import mechanics as m
 
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def parse_polygon(boundary):
+    """
+        Parses a boundary string as written by ImageJ (NuclBound) or np.array2string (CellBound) into a (k, 2)
+        float32 array of x, y vertices. Returns None when there is no boundary.
+    """
+    if not isinstance(boundary, str):
+        return None
+    return np.array(_NUMBER.findall(boundary), dtype=np.float32).reshape(-1, 2)
+
 
 class ImagejPandas(object):
     DIST_THRESHOLD = 0.5  # um before 1 frame of contact
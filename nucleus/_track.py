@@ -76,6 +76,16 @@ class Track():
         self.images = self.images[self.n_channels * skip_frames:, :]
         self.n_frames -= skip_frames
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """ Closes the movie file; segmentation results computed so far are kept. """
+        self.images.close()
+
     def _segment_boundary(self):
         logger.info("Segmenting nuclear boundary")
         self._boundary_pix = pd.DataFrame()
@@ -128,15 +138,17 @@ class Track():
             if self._boundary_pix is None:
                 self._segment_boundary()
 
-            nrm = np.uint8(cv2.normalize(self.images, None, 0, 255, cv2.NORM_MINMAX))
+            # min-max normalization of the whole movie to 8 bits; the nucleus channel is decoded once and its 8-bit
+            # frames shared by every particle
+            lo, hi = map(float, self.images.minmax())
+            alpha = 255.0 / (hi - lo) if hi > lo else 0
+            nrm = [cv2.convertScaleAbs(im, alpha=alpha, beta=-lo * alpha) for im in
+                   image.image_iterator(self.images, channel=self._ch, number_of_frames=self.n_frames)]
             self._features_pix = pd.DataFrame()
 
             for _p, nuc in self._boundary_pix.groupby("particle"):
                 pt_in_nuc = optical_flow_lk_match(
-                    image.mask_iterator(
-                        image.image_iterator(nrm, channel=self._ch, number_of_frames=self.n_frames),
-                        list(nuc.set_index("frame").sort_index()["boundary"].items())
-                    )
+                    image.mask_iterator(nrm, list(nuc.set_index("frame").sort_index()["boundary"].items()))
                 )
                 if pt_in_nuc.empty: continue
 
@@ -109,3 +109,4 @@ if __name__ == '__main__':
         plt.draw()
         drawing_tool.display()
         drawing_tool.savefig(ensure_dir(os.path.join('_mov', 'frame_%02d.png' % f)))
+    t.close()
@@ -13,6 +13,7 @@ import plots
 import tools.plot_tools as sp
 import parameters as p
 import tools.image as image
+import tools.projection as projection
 from tools.interactor import PolygonInteractor
 from tools.draggable import DraggableCircle
 
@@ -79,11 +80,12 @@ def write_centrosome_angle_csv(fname, nucleus, centrosomes):
 
 
 def pick_centrosomes_and_save(file):
-    imgs, pix_per_um, dt, n_frames, n_channels, series = image.load_tiff(file)
-    img = image.retrieve_from_pageseries(series[0], n_frames - 1)
-    n_ztacks, _, sizeX, sizeY = img.shape
-    # z max project and split images into channels
-    tub, act, pact = np.nanmax(img, axis=0)
+    info = image.probe(file)
+    pix_per_um = info.pix_per_um
+    with image.tf.TiffFile(file) as tif:
+        # z max project the last frame and split it into channels
+        tub, act, pact = projection.project_frame(tif.series[0], info.frames - 1, method='max')
+    sizeX, sizeY = tub.shape
 
     print(tub.shape, pact.shape)
     ext = (0, sizeX / pix_per_um, 0, sizeY / pix_per_um)
@@ -1,5 +1,6 @@
 import logging
 import os
+from collections import OrderedDict
 
 import coloredlogs
 import cv2
@@ -17,13 +18,171 @@ from imagej import hdf5_nexus as hdf
 import mechanics as m
 import parameters
 import tools.plot_tools as sp
-from imagej.imagej_pandas import ImagejPandas
-from cell import cell_boundary
+from imagej.imagej_pandas import ImagejPandas, parse_polygon
+from cell import gabor_responses, segment_cells
+from gui.jobs import JobExecutor
 
 pd.options.display.max_colwidth = 10
 coloredlogs.install(fmt='%(levelname)s:%(funcName)s - %(message)s', level=logging.DEBUG)
 
 
+class GaborCache(object):
+    """
+        Stages of the cell segmentation of each frame that don't depend on the threshold: the gabor response and
+        the markers of the nuclei. The last capacity frames are kept in memory and, with persist set, the responses
+        are also stored in the processed group of the run so that they outlive the session. Frames missing from
+        both are filtered in batches, spread over workers threads.
+    """
+
+    def __init__(self, capacity=200, persist=True, workers=None):
+        self.capacity = capacity
+        self.persist = persist
+        self.workers = workers or os.cpu_count() or 1
+        self._frames = OrderedDict()
+
+    def get(self, hdf5file, condition, run, frame):
+        key = (hdf5file, condition, run, frame)
+        if key not in self._frames:
+            self.fill(hdf5file, condition, run, [frame])
+        self._frames.move_to_end(key)
+        return self._frames[key]
+
+    def fill(self, hdf5file, condition, run, frames):
+        """ Brings the given frames of a run into memory, computing the gabor responses that weren't yet. """
+        frames = [fr for fr in frames if (hdf5file, condition, run, fr) not in self._frames]
+        if not frames: return
+
+        hoechst, tubulin = list(), list()
+        with hdf.file_lock, h5py.File(hdf5file, 'r') as f:
+            resolution = hdf.raw_resolution(f, condition, run)
+            nuclei_pos = {fr: hdf.read_frame_positions(f, condition, run, fr, kind='nuclei') for fr in frames}
+            gabor = {fr: hdf.read_gabor_response(f, condition, run, fr) if self.persist else None for fr in frames}
+            missing = [fr for fr in frames if gabor[fr] is None]
+            for fr in missing:
+                hoechst.append(hdf.read_raw(f, condition, run, frame=fr, channel=1))
+                tubulin.append(hdf.read_raw(f, condition, run, frame=fr, channel=2))
+        if missing:
+            gabor.update(zip(missing, gabor_responses(tubulin, hoechst, workers=self.workers)))
+            if self.persist:
+                with hdf.file_lock, h5py.File(hdf5file, 'r+') as f:
+                    for fr in missing:
+                        hdf.write_gabor_response(f, condition, run, fr, gabor[fr])
+
+        for fr in frames:
+            marker = np.zeros(gabor[fr].shape, dtype=np.uint8)
+            for nuc in nuclei_pos[fr]:
+                nid = int(nuc['track_id'])
+                if nid == 0: continue
+                nx = int(nuc['x'] * resolution)
+                ny = int(nuc['y'] * resolution)
+                cv2.circle(marker, (nx, ny), 5, nid, thickness=-1)
+            self._frames[(hdf5file, condition, run, fr)] = (gabor[fr], marker)
+        while len(self._frames) > self.capacity:
+            self._frames.popitem(last=False)
+
+
+def sweep_cell_boundary(hdf5file, condition, run, nuclei, thresholds, cache=None, job=None):
+    """
+        Cell boundary of a nucleus in every frame of the run for each of the gabor thresholds, in one pass over the
+        frames. Returns {threshold: {frame: (polygon, centroid)}} in image units (um).
+    """
+    cache = cache if cache is not None else GaborCache(persist=False)
+    with hdf.file_lock, h5py.File(hdf5file, 'r') as f:
+        resolution = hdf.raw_resolution(f, condition, run)
+        n_frames = hdf.raw_frame_count(f, condition, run)
+
+    # frames are filtered in batches that keep every worker of the cache busy
+    batch = min(2 * cache.workers, cache.capacity)
+    boundaries = {thr: dict() for thr in thresholds}
+    for frame in range(n_frames):
+        if job is not None: job.progress(frame, n_frames)
+        if frame % batch == 0:
+            cache.fill(hdf5file, condition, run, range(frame, min(frame + batch, n_frames)))
+        gabor, marker = cache.get(hdf5file, condition, run, frame)
+        for thr in thresholds:
+            boundary_list, _ = segment_cells(gabor, marker, threshold=thr)
+            for b in boundary_list:
+                if b['id'] == nuclei:
+                    polygon = (b['boundary'] / resolution).astype(np.float32)
+                    boundaries[thr][frame] = (polygon, np.array(b['centroid']) / resolution)
+    return boundaries
+
+
+def cell_boundary_of_nuclei(hdf5file, condition, run, nuclei, threshold, cache=None, job=None):
+    """
+        Segments the cell boundary of a nucleus in every frame of the run with the given gabor threshold, storing
+        the result in the boundary table and cell polygons of the run. A threshold of 0 deletes the boundary.
+        The file is only locked while reading each frame and writing the result, so the viewers keep playing.
+    """
+    hlab = hdf.LabHDF5NeXusFile(filename=hdf5file)
+    with hdf.file_lock, h5py.File(hdf5file, 'r') as f:
+        if nuclei not in hdf.read_selection(f, condition, run).nuclei:
+            return
+
+        # only the rows of the selected nuclei are read and written back
+        fproc = f['%s/%s/processed' % (condition, run)]
+        df = pd.DataFrame()
+        if 'boundary' in fproc:
+            df = hlab.read_processed(condition, run, 'boundary', nuclei=nuclei)
+        if df.empty and 'pandas_dataframe' in fproc:
+            df = hlab.read_processed(condition, run, 'pandas_dataframe', nuclei=nuclei)
+        if df.empty:
+            return
+
+        old_gabor_thr = hdf.gabor_threshold(f, condition, run, nuclei)
+        logging.debug('old gabor thr: %s, new thr: %s new==old %s' %
+                      (old_gabor_thr, threshold, old_gabor_thr == threshold))
+        if old_gabor_thr == threshold:
+            return
+        legacy_cells = 'boundary' in fproc and hdf.read_polygons(f, condition, run, kind='cells') is None
+
+    cell_polygons = dict()
+    if threshold == 0:
+        logging.info('deleting boundary data for nuclei N%02d' % nuclei)
+        ix = df['Nuclei'] == nuclei
+        df.loc[ix, 'CellBound'] = np.NaN
+        df.loc[ix, 'CellX'] = np.NaN
+        df.loc[ix, 'CellY'] = np.NaN
+
+    else:
+        logging.info('computing cell boundary.')
+        boundaries = sweep_cell_boundary(hdf5file, condition, run, nuclei, [threshold], cache=cache, job=job)
+        for frame, (polygon, (cx, cy)) in boundaries[threshold].items():
+            ix = (df['Frame'] == frame) & (df['Nuclei'] == nuclei)
+            if np.any(ix):
+                cell_polygons[frame] = polygon
+                # the string column is kept for the exported tables, drawing reads the polygons
+                np.set_printoptions(threshold=polygon.size)
+                df.loc[ix, 'CellBound'] = np.array2string(polygon, separator=',')
+                df.loc[ix, 'CellX'] = cx
+                df.loc[ix, 'CellY'] = cy
+
+    df = df.rename(columns={'DistCell': 'dist', 'SpdCell': 'speed', 'AccCell': 'acc'})
+    df = m.get_speed_acc_rel_to(df, x='CentX', y='CentY', rx='CellX', ry='CellY',
+                                time='Time', frame='Frame', group='Centrosome')
+    df = df.drop(['_x', '_y'], axis=1).rename(
+        columns={'dist': 'DistCell', 'speed': 'SpdCell', 'acc': 'AccCell'})
+
+    # threshold, polygons and table are written together, once the segmentation is done
+    with hdf.file_lock:
+        if legacy_cells:
+            # boundaries computed before they were stored as polygons, converted once for the other nuclei;
+            # read through pandas before h5py opens the file for writing
+            dfb = hlab.read_processed(condition, run, 'boundary').drop_duplicates(['Nuclei', 'Frame'])
+        with h5py.File(hdf5file, 'r+') as f:
+            hdf.set_gabor_threshold(f, condition, run, nuclei, threshold)
+            if legacy_cells:
+                hdf.write_polygons(f, condition, run, 'cells', dfb['Nuclei'], dfb['Frame'],
+                                   [parse_polygon(b) for b in dfb['CellBound']])
+            frames = sorted(cell_polygons)
+            hdf.write_polygons(f, condition, run, 'cells', [nuclei] * len(frames), frames,
+                               [cell_polygons[fr] for fr in frames], nuclei=nuclei)
+
+        logging.debug('nuclei with cell boundary: %s' % df.loc[~df['CellBound'].isnull(), 'Nuclei'].unique())
+        df = df.loc[:, set(ImagejPandas.MASK_INDEX + ['CellX', 'CellY', 'CellBound'])]
+        hlab.write_processed(condition, run, 'boundary', df, nuclei=nuclei)
+
+
 class ExperimentsList(QWidget):
     def __init__(self, path):
         QWidget.__init__(self)
@@ -50,17 +209,38 @@ class ExperimentsList(QWidget):
         self.timer.timeout.connect(self.anim)
         self.gaborLineEdit.editingFinished.connect(self.on_render_boxplot_button)
 
+        # segmentation runs in the background, one nucleus at a time; only thresholding is redone on a new threshold
+        self.jobs = JobExecutor(self)
+        self.gabor_cache = GaborCache()
+        self.jobs.busy.connect(self.on_jobs_busy)
+        self.jobs.progress.connect(self.on_job_progress)
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.jobs.cancel_all()
+        QWidget.keyPressEvent(self, event)
+
+    @QtCore.pyqtSlot(bool)
+    def on_jobs_busy(self, busy):
+        for widget in [self.experimentsTreeView, self.nucleiListView, self.gaborLineEdit, self.renderBoxplotButton]:
+            widget.setEnabled(not busy)
+        if not busy: self.setWindowTitle('Form')
+
+    @QtCore.pyqtSlot(str, int, int)
+    def on_job_progress(self, description, done, total):
+        self.setWindowTitle('%s: %d/%d (Esc to cancel)' % (description, done, total))
+
     def anim(self):
         if self.total_frames > 0:
             self.frame = (self.frame + 1) % self.total_frames
             self.movieImgLabel.render_frame(self.condition, self.run, self.frame,
-                                            nuclei_selected=self.nuclei_selected)
+                                            nuclei_selected=self.nuclei_selected, playback=True)
 
     def populate_experiments(self):
         model = QtGui.QStandardItemModel()
         self.experimentsTreeView.setModel(model)
         self.experimentsTreeView.setUniformRowHeights(True)
-        with h5py.File(self.hdf5file, 'r') as f:
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
             for cond in reversed(sorted(f.keys())):
                 conditem = QtGui.QStandardItem(cond)
                 for run in f[cond].keys():
@@ -83,6 +263,7 @@ class ExperimentsList(QWidget):
         self.frame = 0
         self.mplDistance.canvas.ax.cla()
         if len(self.condition) > 0:
+            self.build_preview(self.condition, self.run)
             self.populate_frames_list()
             self.movieImgLabel.render_frame(self.condition, self.run, self.frame)
             self.populate_nuclei()
@@ -91,25 +272,38 @@ class ExperimentsList(QWidget):
             self.nucleiListView.model().clear()
             self.movieImgLabel.clear()
 
-        with h5py.File(self.hdf5file, 'r') as f:
-            sel = f['%s/%s/raw' % (self.condition, self.run)]
-            self.total_frames = len(sel)
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            self.total_frames = hdf.raw_frame_count(f, self.condition, self.run)
         self.timer.start(200)
 
+    def build_preview(self, condition, run):
+        # runs ingested without previews get them the first time they are opened; raw images are shown meanwhile
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            if 'preview' in f['%s/%s' % (condition, run)]:
+                return
+
+        def refresh(*args):
+            if (self.condition, self.run) == (condition, run):
+                self.movieImgLabel.reload()
+                self.movieImgLabel.render_frame(self.condition, self.run, self.frame,
+                                                nuclei_selected=self.nuclei_selected)
+
+        self.jobs.submit(lambda job: hdf.LabHDF5NeXusFile(filename=self.hdf5file).add_preview(condition, run),
+                         'building previews of %s-%s' % (condition, run), on_finished=refresh)
+
     def populate_frames_list(self):
-        with h5py.File(self.hdf5file, 'r') as f:
-            sel = f['%s/%s/raw' % (self.condition, self.run)]
-            self.total_frames = len(sel)
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            self.total_frames = hdf.raw_frame_count(f, self.condition, self.run)
 
     def populate_nuclei(self):
         model = QtGui.QStandardItemModel()
         self.nucleiListView.setModel(model)
-        with h5py.File(self.hdf5file, 'r') as f:
-            nuc = f['%s/%s/measurements/nuclei' % (self.condition, self.run)]
-            sel = f['%s/%s/selection' % (self.condition, self.run)]
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            nuc = hdf.track_names(f, self.condition, self.run, kind='nuclei')
+            sel = hdf.read_selection(f, self.condition, self.run)
             for nucID in nuc:
                 conditem = QtGui.QStandardItem(nucID)
-                if nucID in sel:
+                if int(nucID[1:]) in sel.nuclei:
                     conditem.setData(QtCore.QVariant(Qt.Checked), Qt.CheckStateRole)
                 else:
                     conditem.setData(QtCore.QVariant(Qt.Unchecked), Qt.CheckStateRole)
@@ -121,22 +315,24 @@ class ExperimentsList(QWidget):
     def on_nuclei_change(self, current):
         self.nuclei_selected = int(current.data()[1:])
 
-        with h5py.File(self.hdf5file, 'r') as f:
-            nuc_sel = f['%s/%s/selection/N%02d' % (self.condition, self.run, self.nuclei_selected)]
-            gabor_thr = nuc_sel.attrs['gabor_threshold'] if 'gabor_threshold' in nuc_sel.attrs else None
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            gabor_thr = hdf.gabor_threshold(f, self.condition, self.run, self.nuclei_selected)
 
-        hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
-        hlab.process_selection_for_run(self.condition, self.run)
-        if gabor_thr is not None:
-            self.gaborLineEdit.setText(str(gabor_thr))
-            with h5py.File(self.hdf5file, 'r+') as f:
-                nuc_sel = f['%s/%s/selection/N%02d' % (self.condition, self.run, self.nuclei_selected)]
-                nuc_sel.attrs['gabor_threshold'] = gabor_thr
-        else:
-            self.gaborLineEdit.setText('70')
+        self.gaborLineEdit.setText(str(gabor_thr) if gabor_thr is not None else '70')
+        condition, run, nuclei = self.condition, self.run, self.nuclei_selected
 
-        self.movieImgLabel.render_frame(self.condition, self.run, self.frame, nuclei_selected=self.nuclei_selected)
-        self.plot_tracks_of_nuclei(self.nuclei_selected)
+        def process_nuclei(job):
+            hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+            hlab.process_selection_for_run(condition, run, nuclei=nuclei)
+
+        def refresh(*args):
+            if (self.condition, self.run, self.nuclei_selected) == (condition, run, nuclei):
+                self.movieImgLabel.reload()
+                self.movieImgLabel.render_frame(condition, run, self.frame, nuclei_selected=nuclei)
+                self.plot_tracks_of_nuclei(nuclei)
+
+        self.movieImgLabel.render_frame(condition, run, self.frame, nuclei_selected=nuclei)
+        self.jobs.submit(process_nuclei, 'processing N%02d of %s-%s' % (nuclei, condition, run), on_finished=refresh)
 
     @QtCore.pyqtSlot('QStandardItem*')
     def on_gabor_change(self):
@@ -149,106 +345,34 @@ class ExperimentsList(QWidget):
             logging.info('freezing timer.')
             self.timer.stop()
 
-        with h5py.File(self.hdf5file, 'r+') as f:
-            if not 'N%02d' % self.nuclei_selected in f['%s/%s/selection' % (self.condition, self.run)]:
-                self.timer.start(200)
-                return
-
-            if 'boundary' in f['%s/%s/processed' % (self.condition, self.run)]:
-                df = pd.read_hdf(self.hdf5file, key='%s/%s/processed/boundary' % (self.condition, self.run))
-            elif 'pandas_dataframe' in f['%s/%s/processed' % (self.condition, self.run)]:
-                df = pd.read_hdf(self.hdf5file, key='%s/%s/processed/pandas_dataframe' % (self.condition, self.run))
-            else:
-                self.timer.start(200)
-                return
-
-            nuc_sel = f['%s/%s/selection/N%02d' % (self.condition, self.run, self.nuclei_selected)]
-            new_gabor_thr = int(self.gaborLineEdit.text())
-            old_gabor_thr = nuc_sel.attrs['gabor_threshold'] if 'gabor_threshold' in nuc_sel.attrs else None
-            logging.debug('old gabor thr: %s, new thr: %s new==old %s' %
-                          (old_gabor_thr, new_gabor_thr, old_gabor_thr == new_gabor_thr))
+        condition, run, nuclei = self.condition, self.run, self.nuclei_selected
+        threshold = int(self.gaborLineEdit.text())
 
-            if old_gabor_thr == new_gabor_thr:
-                self.timer.start(200)
-                return
-            nuc_sel = f['%s/%s/selection/N%02d' % (self.condition, self.run, self.nuclei_selected)]
-            nuc_sel.attrs['gabor_threshold'] = new_gabor_thr
-
-            if new_gabor_thr == 0:
-                logging.info('deleting boundary data for nuclei N%02d' % self.nuclei_selected)
-                ix = df['Nuclei'] == self.nuclei_selected
-                df.loc[ix, 'CellBound'] = np.NaN
-                df.loc[ix, 'CellX'] = np.NaN
-                df.loc[ix, 'CellY'] = np.NaN
-
-            else:
-                logging.info('computing cell boundary.')
-                for frame in f['%s/%s/raw' % (self.condition, self.run)]:
-                    ch1 = f['%s/%s/raw/%s/channel-1' % (self.condition, self.run, frame)]
-                    ch2 = f['%s/%s/raw/%s/channel-2' % (self.condition, self.run, frame)]
-                    hoechst = ch1[:]
-                    tubulin = ch2[:]
-                    resolution = ch2.parent.attrs['resolution']
-
-                    frame = int(frame)
-                    marker = np.zeros(hoechst.shape, dtype=np.uint8)
-                    nuclei_list = f['%s/%s/measurements/nuclei' % (self.condition, self.run)]
-                    for nucID in nuclei_list:
-                        nuc = nuclei_list[nucID]
-                        nid = int(nucID[1:])
-                        if nid == 0: continue
-                        nfxy = nuc['pos'].value
-                        nuc_frames = nfxy.T[0]
-                        if frame in nuc_frames:
-                            fidx = nuc_frames.searchsorted(frame)
-                            nx = int(nfxy[fidx][1] * resolution)
-                            ny = int(nfxy[fidx][2] * resolution)
-                            cv2.circle(marker, (nx, ny), 5, nid, thickness=-1)
-
-                    boundary_list, gabor = cell_boundary(tubulin, hoechst, markers=marker, threshold=new_gabor_thr)
-                    for b in boundary_list:
-                        nuc = b['id']
-                        if nuc == self.nuclei_selected:
-                            np.set_printoptions(threshold=int(np.prod(b['boundary'].shape)))
-                            boundcell = np.array2string(b['boundary'] / resolution, separator=',')
-                            cx, cy = b['centroid'] / resolution
-                            ix = (df['Frame'] == frame) & (df['Nuclei'] == nuc)
-                            if np.any(ix):
-                                df.loc[ix, 'CellBound'] = boundcell
-                                df.loc[ix, 'CellX'] = cx
-                                df.loc[ix, 'CellY'] = cy
-
-            df = df.rename(columns={'DistCell': 'dist', 'SpdCell': 'speed', 'AccCell': 'acc'})
-            df = m.get_speed_acc_rel_to(df, x='CentX', y='CentY', rx='CellX', ry='CellY',
-                                        time='Time', frame='Frame', group='Centrosome')
-            df = df.drop(['_x', '_y'], axis=1).rename(
-                columns={'dist': 'DistCell', 'speed': 'SpdCell', 'acc': 'AccCell'})
-
-            if 'boundary' in f['%s/%s/processed' % (self.condition, self.run)]:
-                del f['%s/%s/processed/boundary' % (self.condition, self.run)]
+        def done(*args):
+            self.movieImgLabel.reload()
+            self.plot_tracks_of_nuclei(self.nuclei_selected)
+            logging.info('animating again.')
+            self.timer.start(200)
 
-        logging.debug('nuclei with cell boundary: %s' % df.loc[~df['CellBound'].isnull(), 'Nuclei'].unique())
-        df = df.loc[:, set(ImagejPandas.MASK_INDEX + ['CellX', 'CellY', 'CellBound'])]
-        df.to_hdf(self.hdf5file, key='%s/%s/processed/boundary' % (self.condition, self.run), mode='r+')
-        self.plot_tracks_of_nuclei(self.nuclei_selected)
-        logging.info('animating again.')
-        self.timer.start(200)
+        job = self.jobs.submit(lambda job: cell_boundary_of_nuclei(self.hdf5file, condition, run, nuclei, threshold,
+                                                                   cache=self.gabor_cache, job=job),
+                               'cell boundary of N%02d' % nuclei, on_finished=done)
+        job.signals.failed.connect(done)
+        job.signals.cancelled.connect(done)
 
     def plot_tracks_of_nuclei(self, nuclei):
         self.mplDistance.clear()
-        with h5py.File(self.hdf5file, 'r') as f:
+        hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
             if 'pandas_dataframe' in f['%s/%s/processed' % (self.condition, self.run)]:
-                df = pd.read_hdf(self.hdf5file, key='%s/%s/processed/pandas_dataframe' % (self.condition, self.run))
-                mask = pd.read_hdf(self.hdf5file, key='%s/%s/processed/pandas_masks' % (self.condition, self.run))
-                ixdf = df['Nuclei'] == nuclei
-                ixmsk = mask['Nuclei'] == nuclei
-                time, frame, dist = ImagejPandas.get_contact_time(df[ixdf], 10)
-                sp.distance_to_nuclei_center(df[ixdf], self.mplDistance.canvas.ax, mask=mask[ixmsk], time_contact=time)
+                df = hlab.read_processed(self.condition, self.run, 'pandas_dataframe', nuclei=nuclei)
+                mask = hlab.read_processed(self.condition, self.run, 'pandas_masks', nuclei=nuclei)
+                time, frame, dist = ImagejPandas.get_contact_time(df, 10)
+                sp.distance_to_nuclei_center(df, self.mplDistance.canvas.ax, mask=mask, time_contact=time)
 
                 # plot distance with respect to cell centroid
                 if 'boundary' in f['%s/%s/processed' % (self.condition, self.run)]:
-                    df = pd.read_hdf(self.hdf5file, key='%s/%s/processed/boundary' % (self.condition, self.run))
-                    df = df[df['Nuclei'] == nuclei]
+                    df = hlab.read_processed(self.condition, self.run, 'boundary', nuclei=nuclei)
                     # logging.info('columnas de boundary: ' + str(df.columns))
                     if 'DistCell' in df:
                         df = df.set_index('Time').sort_index()
@@ -265,7 +389,7 @@ class ExperimentsList(QWidget):
     def on_render_boxplot_button(self):
         logging.info('Rendering boxplot')
         df_out = pd.DataFrame()
-        with h5py.File(self.hdf5file, 'r') as f:
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
             for experiment_tag in f:
                 for run in f['%s' % experiment_tag]:
                     if 'boundary' in f['%s/%s/processed' % (experiment_tag, run)]:
@@ -343,4 +467,7 @@ if __name__ == '__main__':
     folders = ExperimentsList(os.path.join(parameters.compiled_data_dir, 'centrosomes.nexus.hdf5'))
     folders.show()
 
-    sys.exit(app.exec_())
+    code = app.exec_()
+    folders.jobs.cancel_all()
+    folders.jobs.wait()
+    sys.exit(code)
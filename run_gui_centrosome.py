@@ -13,6 +13,7 @@ from PyQt5.QtWidgets import QAbstractItemView, QWidget
 
 from imagej import hdf5_nexus as hdf
 import parameters
+from gui.jobs import JobExecutor
 import tools.plot_tools as spc
 from imagej.imagej_pandas import ImagejPandas
 
@@ -52,17 +53,46 @@ class SelectionGui(QWidget):
         self.frameHSlider.sliderPressed.connect(self.on_frame_slider_press)
         self.timer.timeout.connect(self.anim)
 
+        # processing actions run in the background, one at a time
+        self.jobs = JobExecutor(self)
+        self.jobs.busy.connect(self.on_jobs_busy)
+        self.jobs.progress.connect(self.on_job_progress)
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.jobs.cancel_all()
+        QWidget.keyPressEvent(self, event)
+
+    @QtCore.pyqtSlot(bool)
+    def on_jobs_busy(self, busy):
+        # selection can't be edited while the file is being rewritten; the movie keeps playing
+        for widget in [self.experimentsTreeView, self.nucleiListView, self.centrosomeListView,
+                       self.centrosomeListView_A, self.centrosomeListView_B, self.exportPandasButton,
+                       self.exportSelectionButton, self.importSelectionButton, self.clearRunButton]:
+            widget.setEnabled(not busy)
+        if not busy: self.setWindowTitle('Form')
+
+    @QtCore.pyqtSlot(str, int, int)
+    def on_job_progress(self, description, done, total):
+        self.setWindowTitle('%s: %d/%d (Esc to cancel)' % (description, done, total))
+
+    def on_selection_changed(self, *args):
+        self.populate_nuclei()
+        self.populate_centrosomes()
+        self.movieImgLabel.reload()
+        self.movieImgLabel.render_frame(self.condition, self.run, self.frame, nuclei_selected=self.nuclei_selected)
+
     def anim(self):
         if self.total_frames > 0:
             self.frame = (self.frame + 1) % self.total_frames
             self.movieImgLabel.render_frame(self.condition, self.run, self.frame,
-                                            nuclei_selected=self.nuclei_selected)
+                                            nuclei_selected=self.nuclei_selected, playback=True)
 
     def populate_experiments(self):
         model = QtGui.QStandardItemModel()
         self.experimentsTreeView.setModel(model)
         self.experimentsTreeView.setUniformRowHeights(True)
-        with h5py.File(self.hdf5file, 'r') as f:
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
             for cond in reversed(sorted(f.keys())):
                 conditem = QtGui.QStandardItem(cond)
                 for run in f[cond].keys():
@@ -85,6 +115,7 @@ class SelectionGui(QWidget):
         self.frame = 0
         self.mplDistance.canvas.ax.cla()
         if len(self.condition) > 0:
+            self.build_preview(self.condition, self.run)
             self.populate_frames_list()
             self.movieImgLabel.render_frame(self.condition, self.run, self.frame)
             self.populate_nuclei()
@@ -97,15 +128,28 @@ class SelectionGui(QWidget):
             self.centrosomeListView_B.model().clear()
             self.movieImgLabel.clear()
 
-        with h5py.File(self.hdf5file, 'r') as f:
-            sel = f['%s/%s/raw' % (self.condition, self.run)]
-            self.total_frames = len(sel)
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            self.total_frames = hdf.raw_frame_count(f, self.condition, self.run)
         self.timer.start(200)
 
+    def build_preview(self, condition, run):
+        # runs ingested without previews get them the first time they are opened; raw images are shown meanwhile
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            if 'preview' in f['%s/%s' % (condition, run)]:
+                return
+
+        def refresh(*args):
+            if (self.condition, self.run) == (condition, run):
+                self.movieImgLabel.reload()
+                self.movieImgLabel.render_frame(self.condition, self.run, self.frame,
+                                                nuclei_selected=self.nuclei_selected)
+
+        self.jobs.submit(lambda job: hdf.LabHDF5NeXusFile(filename=self.hdf5file).add_preview(condition, run),
+                         'building previews of %s-%s' % (condition, run), on_finished=refresh)
+
     def populate_frames_list(self):
-        with h5py.File(self.hdf5file, 'r') as f:
-            sel = f['%s/%s/raw' % (self.condition, self.run)]
-            self.total_frames = len(sel)
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            self.total_frames = hdf.raw_frame_count(f, self.condition, self.run)
             self.frameHSlider.setMaximum(self.total_frames - 1)
 
     @QtCore.pyqtSlot()
@@ -123,12 +167,12 @@ class SelectionGui(QWidget):
     def populate_nuclei(self):
         model = QtGui.QStandardItemModel()
         self.nucleiListView.setModel(model)
-        with h5py.File(self.hdf5file, 'r') as f:
-            nuc = f['%s/%s/measurements/nuclei' % (self.condition, self.run)]
-            sel = f['%s/%s/selection' % (self.condition, self.run)]
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            nuc = hdf.track_names(f, self.condition, self.run, kind='nuclei')
+            sel = hdf.read_selection(f, self.condition, self.run)
             for nucID in nuc:
                 conditem = QtGui.QStandardItem(nucID)
-                if nucID in sel:
+                if int(nucID[1:]) in sel.nuclei:
                     conditem.setData(Qt.Checked, Qt.CheckStateRole)
                 else:
                     conditem.setData(Qt.Unchecked, Qt.CheckStateRole)
@@ -148,25 +192,26 @@ class SelectionGui(QWidget):
     def on_nucleitick_change(self, item):
         self.nuclei_selected = int(item.text()[1:])
         if item.checkState() == QtCore.Qt.Unchecked:
-            with h5py.File(self.hdf5file, 'a') as f:
-                sel = f['%s/%s/selection' % (self.condition, self.run)]
-                del sel['N%02d' % self.nuclei_selected]
-            hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
-            hlab.process_selection_for_run(self.condition, self.run)
-            self.mplDistance.clear()
+            condition, run, nuclei = self.condition, self.run, self.nuclei_selected
 
-        self.populate_nuclei()
-        self.populate_centrosomes()
-        self.movieImgLabel.render_frame(self.condition, self.run, self.frame, nuclei_selected=self.nuclei_selected)
+            def delete_nuclei(job):
+                hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+                hlab.delete_association(None, nuclei, condition, run)
+                hlab.process_selection_for_run(condition, run, nuclei=nuclei)
+
+            self.mplDistance.clear()
+            self.jobs.submit(delete_nuclei, 'deleting N%02d of %s-%s' % (nuclei, condition, run),
+                             on_finished=self.on_selection_changed)
+        else:
+            self.on_selection_changed()
 
     def plot_tracks_of_nuclei(self, nuclei):
         self.mplDistance.clear()
-        with h5py.File(self.hdf5file, 'r') as f:
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
             if 'pandas_dataframe' in f['%s/%s/processed' % (self.condition, self.run)]:
-                df = pd.read_hdf(self.hdf5file, key='%s/%s/processed/pandas_dataframe' % (self.condition, self.run))
-                mask = pd.read_hdf(self.hdf5file, key='%s/%s/processed/pandas_masks' % (self.condition, self.run))
-                df = df[df['Nuclei'] == nuclei]
-                mask = mask[mask['Nuclei'] == nuclei]
+                hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+                df = hlab.read_processed(self.condition, self.run, 'pandas_dataframe', nuclei=nuclei)
+                mask = hlab.read_processed(self.condition, self.run, 'pandas_masks', nuclei=nuclei)
                 toc, foc, doc = ImagejPandas.get_contact_time(df, ImagejPandas.DIST_THRESHOLD)
                 print(toc, foc, doc)
                 spc.distance_to_nuclei_center(df, self.mplDistance.canvas.ax, mask=mask, time_contact=toc)
@@ -185,14 +230,13 @@ class SelectionGui(QWidget):
         self.centrosomeListView_A.setAcceptDrops(True)
         self.centrosomeListView_B.setModel(modelB)
         self.centrosomeListView_B.setAcceptDrops(True)
-        with h5py.File(self.hdf5file, 'r') as f:
-            centrosome_list = list(f['%s/%s/measurements/centrosomes' % (self.condition, self.run)].keys())
-            sel = f['%s/%s/selection' % (self.condition, self.run)]
-            if self.nuclei_selected is not None and 'N%02d' % self.nuclei_selected in sel:
-                sel = sel['N%02d' % self.nuclei_selected]
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            centrosome_list = hdf.track_names(f, self.condition, self.run, kind='centrosomes')
+            sel = hdf.read_selection(f, self.condition, self.run)
+            if self.nuclei_selected is not None and self.nuclei_selected in sel.nuclei:
                 for cntrID in centrosome_list:
-                    centr_in_a = cntrID in sel['A']
-                    centr_in_b = cntrID in sel['B']
+                    centr_in_a = sel.nucleus_of(cntrID) == (self.nuclei_selected, 0)
+                    centr_in_b = sel.nucleus_of(cntrID) == (self.nuclei_selected, 1)
 
                     item = QtGui.QStandardItem(cntrID)
                     if centr_in_a:
@@ -204,9 +248,8 @@ class SelectionGui(QWidget):
                         item.setCheckable(True)
                         modelB.appendRow(item)
 
-        hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
         for cntrID in centrosome_list:
-            if not hlab.is_centrosome_associated(cntrID, self.condition, self.run):
+            if cntrID not in sel:
                 item = QtGui.QStandardItem(cntrID)
                 model.appendRow(item)
 
@@ -218,20 +261,28 @@ class SelectionGui(QWidget):
     @QtCore.pyqtSlot('QStandardItem*')
     def on_centrosometick_change(self, item):
         self.centrosome_selected = str(item.text())
-        hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
         c = int(self.centrosome_selected[1:])
-        if self.centrosome_dropped:
-            self.centrosome_dropped = False
-            hlab.associate_centrosome_with_nuclei(c, self.nuclei_selected, self.condition, self.run,
-                                                  self.centrosome_group)
-            hlab.process_selection_for_run(self.condition, self.run)
-        elif item.checkState() == QtCore.Qt.Unchecked:
-            hlab.delete_association(c, self.nuclei_selected, self.condition, self.run)
+        condition, run, nuclei_selected, group = self.condition, self.run, self.nuclei_selected, self.centrosome_group
+        dropped, self.centrosome_dropped = self.centrosome_dropped, False
+        unchecked = item.checkState() == QtCore.Qt.Unchecked
 
-        self.populate_nuclei()
-        self.populate_centrosomes()
-        self.movieImgLabel.render_frame(self.condition, self.run, self.frame)
-        self.plot_tracks_of_nuclei(self.nuclei_selected)
+        def edit_centrosome(job):
+            hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+            # only the nuclei touched by the edit are reprocessed
+            if dropped:
+                previous = hlab.selection(condition, run).nucleus_of(c)
+                hlab.associate_centrosome_with_nuclei(c, nuclei_selected, condition, run, group)
+                nuclei = [nuclei_selected] + ([previous[0]] if previous is not None else [])
+                hlab.process_selection_for_run(condition, run, nuclei=nuclei)
+            elif unchecked:
+                hlab.delete_association(c, nuclei_selected, condition, run)
+                hlab.process_selection_for_run(condition, run, nuclei=nuclei_selected)
+
+        def refresh(*args):
+            self.on_selection_changed()
+            self.plot_tracks_of_nuclei(self.nuclei_selected)
+
+        self.jobs.submit(edit_centrosome, 'editing C%03d of %s-%s' % (c, condition, run), on_finished=refresh)
 
     @QtCore.pyqtSlot('QModelIndex,int,int')
     def on_centrosome_a_drop(self, item, start, end):
@@ -246,11 +297,14 @@ class SelectionGui(QWidget):
     @QtCore.pyqtSlot()
     def on_clear_run_button(self):
         if self.condition is not None and self.run is not None:
-            hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
-            hlab.clear_associations(self.condition, self.run)
-            hlab.process_selection_for_run(self.condition, self.run)
-            self.populate_nuclei()
-            self.populate_centrosomes()
+            condition, run = self.condition, self.run
+
+            def clear_run(job):
+                hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+                hlab.clear_associations(condition, run)
+                hlab.process_selection_for_run(condition, run)
+
+            self.jobs.submit(clear_run, 'clearing %s-%s' % (condition, run), on_finished=self.on_selection_changed)
 
     @QtCore.pyqtSlot()
     def on_export_pandas_button(self):
@@ -261,15 +315,18 @@ class SelectionGui(QWidget):
         fname = str(fname)
         mname = str(mname)
 
-        self.reprocess_selections()
-        hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
-        logging.info('saving masks to %s' % (mname))
-        msk = hlab.mask
-        msk.to_pickle(mname)
-        logging.info('saving centrosomes to %s' % (fname))
-        df = hlab.dataframe
-        df.to_pickle(fname)
-        logging.info('export finished.')
+        def export(job):
+            self.reprocess_selections(job)
+            hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+            logging.info('saving masks to %s' % (mname))
+            msk = hlab.mask
+            msk.to_pickle(mname)
+            logging.info('saving centrosomes to %s' % (fname))
+            df = hlab.dataframe
+            df.to_pickle(fname)
+            logging.info('export finished.')
+
+        self.jobs.submit(export, 'exporting')
 
     @QtCore.pyqtSlot()
     def on_export_sel_button(self):
@@ -279,17 +336,13 @@ class SelectionGui(QWidget):
         logging.info('saving to %s' % fname)
 
         config = configparser.RawConfigParser()
-        with h5py.File(self.hdf5file, 'r') as f:
-            for cond in f:
-                for run in f[cond]:
-                    for nuclei_str in f['%s/%s/selection' % (cond, run)]:
-                        if nuclei_str == 'pandas_dataframe' or nuclei_str == 'pandas_masks': continue
-                        section = '%s.%s.%s' % (cond, run, nuclei_str)
-                        config.add_section(section)
-                        centrosomes_of_nuclei_a = f['%s/%s/selection/%s/A' % (cond, run, nuclei_str)].keys()
-                        centrosomes_of_nuclei_b = f['%s/%s/selection/%s/B' % (cond, run, nuclei_str)].keys()
-                        config.set(section, 'A', [c.encode('ascii', 'ignore') for c in centrosomes_of_nuclei_a])
-                        config.set(section, 'B', [c.encode('ascii', 'ignore') for c in centrosomes_of_nuclei_b])
+        hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+        for (cond, run, nucl), sel in hlab.selections.groupby(['condition', 'run', 'Nuclei']):
+            section = '%s.%s.N%02d' % (cond, run, nucl)
+            config.add_section(section)
+            for label in ['A', 'B']:
+                centrosomes = sel.loc[sel['CentrLabel'] == label, 'Centrosome']
+                config.set(section, label, [('C%03d' % c).encode('ascii', 'ignore') for c in centrosomes])
 
         # Write our configuration file
         with open(fname, 'w') as configfile:
@@ -303,42 +356,36 @@ class SelectionGui(QWidget):
         if not fname: return
         fname = str(fname)
 
-        logging.info('deleting old selection')
-        with h5py.File(self.hdf5file, 'a') as f:
-            for cond in f:
-                for run in f[cond]:
-                    for o in f['%s/%s/selection' % (cond, run)]:
-                        del f['%s/%s/selection/%s' % (cond, run, o)]
+        with hdf.file_lock, h5py.File(self.hdf5file, 'r') as f:
+            runs = [(cond, run) for cond in f for run in f[cond]]
 
         logging.info('opening %s' % fname)
         selection = configparser.ConfigParser()
         selection.read(fname)
-        for sel in selection.sections():
-            logging.info(sel)
-            cond, run, nucl = re.search('^(.+)\.(.+)\.N(.+)$', sel).groups()
+
+        def import_selection(job):
             hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
+            with hlab.session():
+                logging.info('deleting old selection')
+                for cond, run in runs:
+                    hlab.clear_associations(cond, run)
+
+                for sel in selection.sections():
+                    logging.info(sel)
+                    cond, run, nucl = re.search('^(.+)\.(.+)\.N(.+)$', sel).groups()
+
+                    _A = eval(selection.get(sel, 'a'))
+                    _B = eval(selection.get(sel, 'b'))
+                    hlab.associate_centrosome_with_nuclei(_A, int(nucl), cond, run, centrosome_group=0)
+                    hlab.associate_centrosome_with_nuclei(_B, int(nucl), cond, run, centrosome_group=1)
+            self.reprocess_selections(job)
+            logging.info('done importing selection.')
+
+        self.jobs.submit(import_selection, 'importing selection', on_finished=self.on_selection_changed)
 
-            _A = eval(selection.get(sel, 'a'))
-            _B = eval(selection.get(sel, 'b'))
-            for c in _A:
-                hlab.associate_centrosome_with_nuclei(int(c[1:]), int(nucl), cond, run, centrosome_group=0)
-            for c in _B:
-                hlab.associate_centrosome_with_nuclei(int(c[1:]), int(nucl), cond, run, centrosome_group=1)
-        self.reprocess_selections()
-        logging.info('done importing selection.')
-
-    def reprocess_selections(self):
-        with h5py.File(self.hdf5file, 'r') as f:
-            conditions = list(f.keys())
+    def reprocess_selections(self, job=None):
         hlab = hdf.LabHDF5NeXusFile(filename=self.hdf5file)
-        for cond in conditions:
-            with h5py.File(self.hdf5file, 'a') as f:
-                runs = list(f[cond].keys())
-            for run in runs:
-                try:
-                    hlab.process_selection_for_run(cond, run)
-                except KeyError as e:
-                    logging.warning('skipping %s-%s due to lack of data. %s' % (cond, run, e))
+        hlab.reprocess_selections(workers=os.cpu_count() or 1, progress=job.progress if job is not None else None)
 
 
 if __name__ == '__main__':
@@ -359,4 +406,7 @@ if __name__ == '__main__':
     gui = SelectionGui(os.path.join(parameters.compiled_data_dir, 'centrosomes.nexus.hdf5'))
     gui.show()
 
-    sys.exit(app.exec_())
+    code = app.exec_()
+    gui.jobs.cancel_all()
+    gui.jobs.wait()
+    sys.exit(code)
@@ -0,0 +1,27 @@
+import argparse
+import logging
+import os
+import time
+
+import parameters
+from imagej.hdf5_nexus import LabHDF5NeXusFile
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rebuilds the processed tables of the runs whose centrosome selection changed.')
+    parser.add_argument('hdf5', nargs='?', default=os.path.join(parameters.compiled_data_dir, 'centrosomes.nexus.hdf5'),
+                        help='HDF5 NeXus file with the experiments')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes reprocessing runs in parallel')
+    parser.add_argument('--force', action='store_true', help='reprocess every run, even if its selection is unchanged')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    hdf5 = LabHDF5NeXusFile(filename=args.hdf5)
+    timings = hdf5.reprocess_selections(workers=args.workers, force=args.force)
+
+    print('%-30s %-30s %10s' % ('condition', 'run', 'time (s)'))
+    for condition, run, elapsed in sorted(timings, key=lambda t: -t[2]):
+        print('%-30s %-30s %10.2f' % (condition, run, elapsed))
+    print('%d runs reprocessed in %0.2f s' % (len(timings), time.time() - t0))
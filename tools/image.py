@@ -1,7 +1,10 @@
 import logging
 import os
+import threading
 import xml.etree
 import xml.etree.ElementTree
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -15,77 +18,247 @@ import tools.measurements as meas
 logger = logging.getLogger(__name__)
 
 
-def load_tiff(path):
+class LazyStack(object):
+    """
+        The planes of a tiff file as a (N, Y, X) stack that is read on demand, indexed like the array load_tiff used
+        to return. The contiguous payload of ImageJ hyperstacks is memory-mapped; otherwise each page is decoded
+        when it is indexed, from a file kept open until close. Slicing the planes gives another LazyStack, and
+        np.asarray reads the whole stack into memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tif = None
+        self._lock = threading.Lock()
+        try:
+            data = tf.memmap(path, mode='r')
+        except ValueError:
+            data = None
+        if data is not None:
+            self._planes = data.reshape((-1,) + data.shape[-2:])
+        else:
+            self._tif = tf.TiffFile(path)
+            if len(self._tif.pages) > 1:
+                self._planes = None
+            else:
+                logger.warning('%s is neither contiguous nor one page per plane, decoding it in memory.' % path)
+                page = self._tif.pages[0].asarray()
+                self._planes = page.reshape((-1,) + page.shape[-2:])
+        self._index = np.arange(len(self._planes) if self._planes is not None else len(self._tif.pages))
+
+    def _plane(self, i):
+        if self._planes is not None:
+            return self._planes[i]
+        with self._lock:
+            return self._tif.pages[i].asarray()
+
+    @property
+    def shape(self):
+        plane = self._planes[0] if self._planes is not None else self._tif.pages[0]
+        return (len(self._index),) + tuple(plane.shape)
+
+    @property
+    def dtype(self):
+        return self._planes.dtype if self._planes is not None else self._tif.pages[0].dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        for i in self._index:
+            yield self._plane(i)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        ix, rest = key[0], key[1:]
+        if np.isscalar(ix):
+            return self._plane(self._index[ix])[rest]
+        if all(isinstance(k, slice) and k == slice(None) for k in rest):
+            sub = LazyStack.__new__(LazyStack)
+            sub.__dict__.update(self.__dict__)
+            sub._index = self._index[ix]
+            return sub
+        return np.stack([self._plane(i)[rest] for i in self._index[ix]])
+
+    def __array__(self, dtype=None):
+        out = np.stack(list(self)) if len(self) > 0 else np.empty(self.shape, dtype=self.dtype)
+        return out if dtype is None else out.astype(dtype)
+
+    def min(self):
+        return min(plane.min() for plane in self)
+
+    def max(self):
+        return max(plane.max() for plane in self)
+
+    def minmax(self):
+        """ (min, max) of the stack, reading each plane once. """
+        lo, hi = None, None
+        for plane in self:
+            plo, phi = plane.min(), plane.max()
+            lo = plo if lo is None else min(lo, plo)
+            hi = phi if hi is None else max(hi, phi)
+        return lo, hi
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+
+
+ImageInfo = namedtuple('ImageInfo', ['path', 'pix_per_um', 'dt', 'frames', 'channels', 'width', 'height'])
+
+_calibration = dict()
+
+
+def _calibration_table():
+    # the eb3 calibration table, parsed again only when the file changes
+    path = parameters.out_dir + 'eb3/eb3_calibration.xls'
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    if path not in _calibration or _calibration[path][0] != mtime:
+        _calibration[path] = (mtime, pd.read_excel(path))
+    return _calibration[path][1]
+
+
+def read_tiff_info(tif, path):
+    """ Metadata of an open ImageJ tiff as an ImageInfo, from its tags only. """
     _, img_name = os.path.split(path)
+    metadata = tif.pages[0].imagej_tags
+    dt = metadata['finterval'] if 'finterval' in metadata else 1
+
+    # asuming square pixels
+    xr = tif.pages[0].tags['x_resolution'].value
+    res = float(xr[0]) / float(xr[1])  # pixels per um
+    if metadata['unit'] == 'centimeter':
+        res = res / 1e4
+
+    # This is a hack
+    # Process pixel calibration from excel file if given
+    cal = _calibration_table()
+    if cal is not None:
+        calp = cal[cal['filename'] == img_name]
+        if not calp.empty:
+            calp = calp.iloc[0]
+            if calp['optivar'] == 'yes':
+                logging.info('file with optivar configuration selected!')
+                res *= 1.6
+
+    return ImageInfo(path, res, dt,
+                     metadata['frames'] if 'frames' in metadata else 1,
+                     metadata['channels'] if 'channels' in metadata else 1,
+                     tif.pages[0].image_width, tif.pages[0].image_length)
+
+
+def load_tiff(path):
     with tf.TiffFile(path) as tif:
         if tif.is_imagej is not None:
-            metadata = tif.pages[0].imagej_tags
-            dt = metadata['finterval'] if 'finterval' in metadata else 1
-
-            # asuming square pixels
-            xr = tif.pages[0].tags['x_resolution'].value
-            res = float(xr[0]) / float(xr[1])  # pixels per um
-            if metadata['unit'] == 'centimeter':
-                res = res / 1e4
-
-            # This is a hack
-            # Process pixel calibration from excel file if given
-            if os.path.exists(parameters.out_dir + 'eb3/eb3_calibration.xls'):
-                cal = pd.read_excel(parameters.out_dir + 'eb3/eb3_calibration.xls')
-                calp = cal[cal['filename'] == img_name]
-                if not calp.empty:
-                    calp = calp.iloc[0]
-                    if calp['optivar'] == 'yes':
-                        logging.info('file with optivar configuration selected!')
-                        res *= 1.6
-
-            images = None
-            if len(tif.pages) == 1:
-                if ('slices' in metadata and metadata['slices'] > 1) or (
-                        'frames' in metadata and metadata['frames'] > 1):
-                    images = tif.pages[0].asarray()
-                else:
-                    images = [tif.pages[0].asarray()]
-            elif len(tif.pages) > 1:
-                images = list()
-                for i, page in enumerate(tif.pages):
-                    images.append(page.asarray())
-
-            return np.asarray(images), res, dt, \
-                   metadata['frames'] if 'frames' in metadata else 1, \
-                   metadata['channels'] if 'channels' in metadata else 1, \
-                   tif.series
-
-
-def load_zeiss(path):
-    _, img_name = os.path.split(path)
+            info = read_tiff_info(tif, path)
+            return LazyStack(path), info.pix_per_um, info.dt, info.frames, info.channels, tif.series
+
+
+def read_zeiss_metadata(czi):
+    """
+        Pixel calibration (pixels per um), frame interval and dimensions of an open CziFile, read from its metadata,
+        TimeStamps attachment and subblock directory without touching pixel data.
+    """
+    xmltxt = czi.metadata()
+    meta = xml.etree.ElementTree.fromstring(xmltxt)
+
+    # next line is somewhat cryptic, but just extracts um/pix (calibration) of X and Y into res
+    res = [float(i[0].text) for i in meta.findall('.//Scaling/Items/*') if
+           i.attrib['Id'] == 'X' or i.attrib['Id'] == 'Y']
+    assert res[0] == res[1], "pixels are not square"
+
+    # get first calibration value and convert it from meters to um
+    res = res[0] * 1e6
+
+    ts_ix = [k for k, a1 in enumerate(czi.attachment_directory) if a1.filename[:10] == 'TimeStamps'][0]
+    timestamps = czi.attachment_directory[ts_ix].data_segment().data()
+    dt = np.median(np.diff(timestamps))
+
+    ax_dct = {n: k for k, n in enumerate(czi.axes)}
+    return {'resolution': 1 / res, 'dt': dt,
+            'frames': czi.shape[ax_dct['T']], 'channels': czi.shape[ax_dct['C']],
+            'width': czi.shape[ax_dct['X']], 'height': czi.shape[ax_dct['Y']]}
+
+
+class ZeissFrames(object):
+    """
+        The planes of a czi file indexed by (T, C), decoded from their subblocks when they are indexed. Subblocks
+        are found through the subblock directory; when several share a (T, C), e.g. the positions of a
+        multi-position acquisition, they are returned stacked in directory order. The file is kept open until close.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._czi = CziFile(path)
+        # frames may be indexed from several threads, see _decode_subblock
+        self._czi._fh.lock = True
+        self.metadata = read_zeiss_metadata(self._czi)
+        self._entries = dict()
+        origin = dict(zip(self._czi.axes, self._czi.start))
+        for entry in self._czi.subblock_directory:
+            start = dict(zip(entry.axes, entry.start))
+            key = (start.get('T', 0) - origin.get('T', 0), start.get('C', 0) - origin.get('C', 0))
+            self._entries.setdefault(key, list()).append(entry)
+
+    @property
+    def shape(self):
+        return self.metadata['frames'], self.metadata['channels']
+
+    def __getitem__(self, key):
+        entries = self._entries[key]
+        planes = [_decode_subblock(entry, self.metadata) for entry in entries]
+        return planes[0] if len(planes) == 1 else np.stack(planes)
+
+    def close(self):
+        self._czi.close()
+
+
+def _decode_subblock(entry, meta):
+    # czifile seeks and reads the segment under the lock of the file handle, which only takes effect once it is
+    # enabled with czi._fh.lock = True (as CziFile.asarray does); decompression runs outside of it, so threads that
+    # share the file only wait for each other's reads
+    return entry.data_segment().data().reshape((meta['width'], meta['height']))
+
+
+def load_zeiss(path, workers=None, lazy=False):
+    """
+        With lazy set, the images are returned as a ZeissFrames accessor instead of being decoded. Otherwise the
+        subblocks are decoded over workers threads, all the cores by default.
+    """
+    if lazy:
+        frames = ZeissFrames(path)
+        meta = frames.metadata
+        return frames, meta['resolution'], meta['dt'], meta['frames'], meta['channels'], None
+
+    workers = workers or os.cpu_count() or 1
     with CziFile(path) as czi:
-        xmltxt = czi.metadata()
-        meta = xml.etree.ElementTree.fromstring(xmltxt)
-
-        # next line is somewhat cryptic, but just extracts um/pix (calibration) of X and Y into res
-        res = [float(i[0].text) for i in meta.findall('.//Scaling/Items/*') if
-               i.attrib['Id'] == 'X' or i.attrib['Id'] == 'Y']
-        assert res[0] == res[1], "pixels are not square"
-
-        # get first calibration value and convert it from meters to um
-        res = res[0] * 1e6
-
-        ts_ix = [k for k, a1 in enumerate(czi.attachment_directory) if a1.filename[:10] == 'TimeStamps'][0]
-        timestamps = list(czi.attachments())[ts_ix].data()
-        dt = np.median(np.diff(timestamps))
-
-        ax_dct = {n: k for k, n in enumerate(czi.axes)}
-        n_frames = czi.shape[ax_dct['T']]
-        n_channels = czi.shape[ax_dct['C']]
-        n_X = czi.shape[ax_dct['X']]
-        n_Y = czi.shape[ax_dct['Y']]
-
-        images = list()
-        for sb in czi.subblock_directory:
-            images.append(sb.data_segment().data().reshape((n_X, n_Y)))
-
-        return np.array(images), 1 / res, dt, n_frames, n_channels, None
+        meta = read_zeiss_metadata(czi)
+        czi._fh.lock = True
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            images = list(executor.map(lambda entry: _decode_subblock(entry, meta), czi.subblock_directory))
+
+        return np.array(images), meta['resolution'], meta['dt'], meta['frames'], meta['channels'], None
+
+
+def probe(path):
+    """
+        Resolution, frame interval, number of frames and channels and plane size of a czi or ImageJ tiff file as an
+        ImageInfo, read from the headers without decoding any pixel data. None for tiffs not written by ImageJ.
+    """
+    if path[-4:] == '.czi':
+        with CziFile(path) as czi:
+            meta = read_zeiss_metadata(czi)
+        return ImageInfo(path, meta['resolution'], meta['dt'], meta['frames'], meta['channels'],
+                         meta['width'], meta['height'])
+    with tf.TiffFile(path) as tif:
+        if tif.is_imagej is not None:
+            return read_tiff_info(tif, path)
 
 
 def find_image(img_name, folder=None):
@@ -110,15 +283,53 @@ def retrieve_image(image_arr, frame, channel=0, number_of_frames=1):
     return image_arr[ix]
 
 
+def series_page_index(series):
+    """
+        Index of the plane of each (t, z, c) of a TZCYX page series, as a (T, Z, C) array. Planes are stored in the
+        order of the axes, either one per page or contiguous after the first page.
+    """
+    assert series.axes == 'TZCYX', "can't handle series at the moment (got %s)." % series.axes
+    return np.arange(int(np.prod(series.shape[:3]))).reshape(series.shape[:3])
+
+
+# the pages of a series share the handle of their file, which can't be read from two threads at once
+_pages_lock = threading.Lock()
+
+
+def series_planes_addressable(series):
+    """ Whether single planes of a page series can be read on their own, i.e. one page per plane or contiguous. """
+    return len(series.pages) == int(np.prod(series.shape[:-2])) or series.offset is not None
+
+
+def read_series_planes(series, planes):
+    """
+        Decodes only the given planes of a page series, as an array of shape planes.shape + (Y, X). Series that
+        aren't series_planes_addressable are decoded whole on every call.
+    """
+    planes = np.asarray(planes)
+    n_planes = int(np.prod(series.shape[:-2]))
+    if len(series.pages) == n_planes:
+        with _pages_lock:
+            images = [series.pages[int(i)].asarray() for i in planes.ravel()]
+    elif series.offset is not None:
+        # contiguous ImageJ hyperstack, the series only holds its first page
+        fh = series.parent.filehandle
+        data = np.memmap(fh.path, dtype=np.dtype(series.parent.byteorder + series.dtype.char), mode='r',
+                         offset=series.offset, shape=(n_planes,) + tuple(series.shape[-2:]))
+        images = [data[int(i)].astype(series.dtype.newbyteorder('=')) for i in planes.ravel()]
+        del data
+    else:
+        logger.warning('series is neither contiguous nor one page per plane, decoding all of it.')
+        return series.asarray().reshape((n_planes,) + tuple(series.shape[-2:]))[planes]
+    return np.stack(images).reshape(planes.shape + tuple(series.shape[-2:]))
+
+
 def retrieve_from_pageseries(series: tf.tifffile.TiffPageSeries, frame, channel='all', zstack='all'):
-    idx = series.axes
-    assert idx == 'TZCYX', "can't handle series at the moment (got %s)." % idx
-    # logger.debug("retrieving frame %d of channel %d (index=%d)" % (frame, channel, ix))
     if channel == 'all':
-        channel = slice(series.shape[idx.find('C')])
+        channel = slice(None)
     if zstack == 'all':
-        zstack = slice(series.shape[idx.find('Z')])
-    return series.asarray()[frame, zstack, channel, :, :]
+        zstack = slice(None)
+    return read_series_planes(series, series_page_index(series)[frame, zstack, channel])
 
 
 def image_iterator(image_arr, channel=0, number_of_frames=1):
@@ -19,7 +19,7 @@ import scipy.stats
 
 import mechanics as m
 from tools import stats
-from imagej.imagej_pandas import ImagejPandas
+from imagej.imagej_pandas import ImagejPandas, parse_polygon
 
 logger = logging.getLogger(__name__)
 
@@ -626,7 +626,7 @@ def render_cell(df, ax, img=None, res=4.5, w=50, h=50):
     _cb = df[df['CentrLabel'] == 'B']
 
     if not _ca['NuclBound'].empty:
-        nucleus = Polygon(eval(_ca['NuclBound'].values[0][1:-1]))
+        nucleus = Polygon(parse_polygon(_ca['NuclBound'].values[0]))
 
         nuc_center = nucleus.centroid
         x, y = nucleus.exterior.xy
@@ -635,7 +635,7 @@ def render_cell(df, ax, img=None, res=4.5, w=50, h=50):
                 zorder=1)
 
     if not _ca['CellBound'].empty:
-        cell = Polygon(eval(_ca['CellBound'].values[0])) if not _ca['CellBound'].empty > 0 else None
+        cell = Polygon(parse_polygon(_ca['CellBound'].values[0])) if not _ca['CellBound'].empty > 0 else None
 
         cll_center = cell.centroid
         x, y = cell.exterior.xy
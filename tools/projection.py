@@ -0,0 +1,117 @@
+"""
+    Projections over z of TZCYX movies, computed one plane at a time: every z-slice of a (frame, channel) is read
+    on its own and folded into a running max, mean or sum, so that only a couple of planes per worker are in
+    memory whatever the size of the z-stacks.
+
+    Run from the repository root to add the projection of a movie as the raw images of a run:
+        python -m tools.projection movie.tif centrosomes.nexus.hdf5 condition run --method max
+"""
+import argparse
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tools.image as image
+from imagej.hdf5_nexus import LabHDF5NeXusFile, read_tiff_metadata
+
+PROJECTIONS = ('max', 'mean', 'sum')
+
+
+def project_plane(series, frame, channel, method='max'):
+    """
+        Projection over z of one channel of a frame of a TZCYX page series, as a (Y, X) array. The series has to be
+        image.series_planes_addressable for this to read only the planes of the frame.
+    """
+    assert method in PROJECTIONS, 'unknown projection %s.' % method
+    planes = image.series_page_index(series)[frame, :, channel]
+    out = None
+    for plane in planes:
+        img = image.read_series_planes(series, plane)
+        if out is None:
+            out = img.astype(np.float64) if method != 'max' else img
+        elif method == 'max':
+            np.maximum(out, img, out)
+        else:
+            out += img
+    if method == 'mean':
+        out /= len(planes)
+    return out
+
+
+def _bounded_map(fn, items, workers):
+    # same as hdf5_nexus._bounded_map but with threads, as page series can't be pickled; pages of a file are
+    # decoded one at a time, but reading contiguous hyperstacks and folding the planes run in parallel
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def project_frames(series, method='max', frames=None, workers=1):
+    """
+        Yields the (C, Y, X) projection of each frame of a TZCYX page series, in order. Planes of every channel and
+        frame are projected in parallel over workers threads, with at most workers of them in flight.
+    """
+    # planes are read one at a time, which would decode the whole movie for each of them otherwise
+    assert image.series_planes_addressable(series), \
+        "can't project series that are neither contiguous nor one page per plane."
+    n_frames, _, n_channels = image.series_page_index(series).shape
+    # frames is walked twice, for the planes and for the output
+    frames = range(n_frames) if frames is None else list(frames)
+    planes = _bounded_map(lambda fc: project_plane(series, fc[0], fc[1], method=method),
+                          ((fr, c) for fr in frames for c in range(n_channels)), workers)
+    for _ in frames:
+        yield np.stack([next(planes) for c in range(n_channels)])
+
+
+def project_frame(series, frame, method='max', workers=1):
+    """ (C, Y, X) projection of a single frame of a TZCYX page series. """
+    return next(project_frames(series, method=method, frames=[frame], workers=workers))
+
+
+def add_projection(hdf5, tiffpath, experiment_tag, run, method='max', layout='stack', compression='gzip',
+                   workers=1):
+    """
+        Adds the projection of a TZCYX movie as the raw images of a run of a LabHDF5NeXusFile, written frame by
+        frame as they are projected. Mean projections are rounded and sums saturate to the 16 bits of the raw
+        layout.
+    """
+    with image.tf.TiffFile(tiffpath) as tif:
+        series = tif.series[0]
+        meta = read_tiff_metadata(tif)
+        assert meta is not None, '%s is not an ImageJ hyperstack.' % tiffpath
+        meta['frames'], _, meta['channels'] = image.series_page_index(series).shape
+        frames = project_frames(series, method=method, workers=workers)
+        if method != 'max':
+            frames = (np.clip(np.rint(fr), 0, np.iinfo(np.uint16).max).astype(np.uint16) for fr in frames)
+        hdf5.add_tiff_sequence(tiffpath, experiment_tag, run, layout=layout, compression=compression,
+                               decoded=(meta, frames))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Adds the z projection of a TZCYX movie as the raw images of a run.')
+    parser.add_argument('tiff', help='ImageJ hyperstack with TZCYX axes')
+    parser.add_argument('hdf5', help='HDF5 NeXus file where the run is added')
+    parser.add_argument('condition')
+    parser.add_argument('run')
+    parser.add_argument('--method', choices=PROJECTIONS, default='max')
+    parser.add_argument('--layout', choices=['frames', 'stack'], default='stack')
+    parser.add_argument('--workers', type=int, default=1, help='number of threads projecting planes in parallel')
+    args = parser.parse_args()
+
+    hdf5 = LabHDF5NeXusFile(filename=args.hdf5, fileflag='r' if os.path.exists(args.hdf5) else 'w')
+    hdf5.add_experiment(args.condition, args.run)
+    add_projection(hdf5, args.tiff, args.condition, args.run, method=args.method, layout=args.layout,
+                   workers=args.workers)
@@ -70,12 +70,26 @@ def baseround(x, base=5):
 
 def reconstruct_time(df):
     # reconstruct time of tracks analyzed with Fiji plugin to match Matlab
-    odf = pd.DataFrame()
-    for _, _df in df.groupby(ImagejPandas.CENTROSOME_INDIV_INDEX):
-        delta = baseround(_df['Time'][0:2].diff().iloc[1])
-        _df.loc[:, 'Time'] = _df['Frame'] * delta
-        odf = odf.append(_df)
-    return odf
+    if df.empty: return df
+    df = df.dropna(subset=ImagejPandas.CENTROSOME_INDIV_INDEX)
+    grp = df.groupby(ImagejPandas.CENTROSOME_INDIV_INDEX, sort=True, observed=True)
+    track = grp.ngroup().values
+    pos = grp.cumcount().values
+    time_ = df['Time'].values
+
+    # time step of each track from its first two time points, rounded to a multiple of 5 like baseround
+    t0 = np.full(track.max() + 1, np.nan)
+    t1 = np.full(track.max() + 1, np.nan)
+    t0[track[pos == 0]] = time_[pos == 0]
+    t1[track[pos == 1]] = time_[pos == 1]
+    delta = 5 * np.round((t1 - t0) / 5)
+    if np.isfinite(delta).all():
+        delta = delta.astype(np.int64)
+
+    df = df.copy()
+    df.loc[:, 'Time'] = df['Frame'].values * delta[track]
+    # tracks one after the other, as they come out of groupby
+    return df.iloc[np.argsort(track, kind='mergesort')]
 
 
 def extract_consecutive_timepoints(df):